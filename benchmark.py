@@ -0,0 +1,318 @@
+# A script for benchmarking the hot paths: evolution, mineral grid, and ExoPlex import.
+# Each workload is fixed, so runs are comparable: it is timed (best of several repeats), run once more
+# under tracemalloc for its peak memory, and its final-state values are kept. Results are compared
+# against a saved baseline; slower or bigger than the threshold, or different final values, is a regression.
+# Correctness checks run alongside: the fast paths (ThermEvBatch, the jit kernel, the adaptive integrator)
+# against the plain ThermEv Euler loop, and the ThermalInterpolator against the table lookups it replaced,
+# each within a fixed tolerance. A failed check is a regression whether or not there is a baseline, and
+# --save refuses to record one.
+# Recommended use:
+#   python benchmark.py --save          # record a baseline on this machine (benchmark_baseline.json)
+#   python benchmark.py                 # compare against it; exits with status 1 on any regression
+#   python benchmark.py --only ThermEv  # run the workloads (and checks) whose name contains 'ThermEv'
+#   python benchmark.py --only import   # cold-start time of a headless worker
+#   python benchmark.py --only check    # the correctness checks only
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+import evolve
+import ensemble
+import fromexo
+import kernel
+import sweep
+import runcache
+import getall as get
+import thermalgrid
+from constants import *
+
+here = os.path.dirname(os.path.abspath(__file__))
+baselinefile = os.path.join(here, 'benchmark_baseline.json')
+exoplexfile = os.path.join(here, 'earth_nomantleFe_FeMg0.9_0.07_0.9_0.09_0.9.csv')
+
+WORKLOADS = {}
+CHECKS = {}
+inputs = {}  # shared inputs, prepared once by run() outside the timings
+runcache.enabled = False   # every workload computes its runs
+
+def workload(name, repeat=5):
+    # Registers a benchmark: a function with no arguments that returns a dictionary of final values
+    def register(function):
+        WORKLOADS[name] = (function, repeat)
+        return function
+    return register
+
+def check(name, tolerance):
+    # Registers a correctness check: a function with no arguments that returns the largest relative difference
+    #   between a fast path and the plain code it stands in for; it passes if that is within tolerance
+    def register(function):
+        CHECKS[name] = (function, tolerance)
+        return function
+    return register
+
+def exoplex_planet():
+    # The bundled ExoPlex Earth, set up as getall.setup does for a 'dynamic' run at Pref = 6 GPa
+    planet = {'ID': 'earth', 'Tp0': 2000.0, 'Pref': 6.0, 'outcols': list(outcols), 'constants': {'beta': 0.33}}
+    planet['composition'] = get.adds_up(fromexo.bulk_mass_fraction(exoplexfile))
+    return fromexo.build(planet, exoplexfile)
+
+def final(Evolution):
+    return {c: float(Evolution[c].iloc[-1]) for c in ('temp', 'Ra', 'Urey')}
+
+@workload('import_headless', repeat=3)
+def import_headless():
+    # Cold start of a batch worker, in a fresh interpreter: none of the plotting packages or scipy may be imported
+    code = ('import sys, evolve, fromexo, getall, sweep, ensemble; '
+            'print(sum(m in sys.modules for m in (\'matplotlib\', \'plotly\', \'scipy\')))')
+    out = subprocess.run([sys.executable, '-c', code], cwd=here, stdout=subprocess.PIPE, check=True)
+    return {'heavy_modules': int(out.stdout.split()[-1])}
+
+@workload('exoplex_build')
+def exoplex_build():
+    fromexo._profiles.clear()   # parse the file afresh
+    planet = exoplex_planet()
+    return {key: float(planet[key]) for key in ('Mp', 'Mc', 'Rc', 'alpha', 'Cp', 'k')}
+
+@workload('planets_from_summary')
+def planets_from_summary():
+    planets = fromexo.planets_from_summary()
+    return {'planets': len(planets), 'Mass_Me': float(sum(p['Mass_Me'] for p in planets.values()))}
+
+def summary_planets(Tp0=DEFAULT['Tp0']):
+    # Every planet of cumulative.csv, as sweep.run_summary sets them up
+    files = fromexo.planets_from_summary()
+    return [fromexo.summary_planet(files[ID], ID, Tp0=Tp0) for ID in files]
+
+@workload('summary_sweep', repeat=3)
+def summary_sweep():
+    # Every planet of cumulative.csv evolved one by one ('dynamic'), in this process
+    Evolutions, status = sweep.run_summary(method='dynamic', workers=1)
+    ok = status[status['status'] == 'ok']
+    return {'ok': len(ok), 'temp_mean': float(ok['temp'].mean()), 'Urey_mean': float(ok['Urey'].mean())}
+
+@workload('summary_batch', repeat=3)
+def summary_batch():
+    # The same planets, mixed in one batch (get.thermals_for_many) and evolved together by ThermEvBatch
+    params, thermals = evolve.batch_params(summary_planets(), 'dynamic')
+    Hts, passfail = evolve.ThermEvBatch(params, thermals, tmax, frame=False)
+    return {'planets': Hts.n, 'temp_mean': float(np.nanmean(Hts.final('temp'))),
+            'Urey_mean': float(np.nanmean(Hts.final('Urey')))}
+
+@workload('thermals_at_P_ave_uncached', repeat=20)
+def thermals_uncached():
+    get.clear_thermals_cache()
+    thermals = get.thermals_at_P_ave(inputs['composition'], 6.0)
+    return {'alpha': float(thermals[161, 1]), 'Cp': float(thermals[161, 2]), 'k': float(thermals[161, 3])}
+
+@workload('thermals_at_P_ave_cached', repeat=20)
+def thermals_cached():
+    thermals = get.thermals_at_P_ave(inputs['composition'], 6.0)
+    return {'alpha': float(thermals[161, 1]), 'Cp': float(thermals[161, 2]), 'k': float(thermals[161, 3])}
+
+@workload('thermals_by_depth', repeat=20)
+def thermals_by_depth():
+    thermals = get.thermals_by_depth(fromexo.load_profile(exoplexfile))
+    return {'alpha': float(thermals[161, 1]), 'Cp': float(thermals[161, 2]), 'k': float(thermals[161, 3])}
+
+@workload('ThermEv_dynamic')
+def thermev_dynamic():
+    planet = dict(inputs['planet'])
+    return final(evolve.ThermEv(planet, None, 'dynamic', planet['Tp0'], tmax))
+
+def preset(name, parameters):
+    @workload('ThermEv_' + name)
+    def run():
+        planet = dict(parameters)
+        planet.update({'ID': name, 'outcols': list(outcols), 'constants': {}})
+        return final(evolve.ThermEv(planet, None, parameters['method'], parameters.get('Tp0', DEFAULT['Tp0']), tmax))
+    return run
+
+for name, parameters in (('STO', STO), ('MC', MC), ('KK', KK)):
+    preset(name, parameters)
+
+def ensemble_of(n, repeat):
+    @workload('ensemble_' + str(n), repeat=repeat)
+    def run():
+        samples, bands = ensemble.run(n, seed=42)
+        return {'temp_p50': float(bands['temp_p50'].iloc[-1]), 'passed': int(samples['passfail'].sum())}
+    return run
+
+for n, repeat in ((1, 5), (100, 5), (10000, 1)):
+    ensemble_of(n, repeat)
+
+@check('check_batch_vs_ThermEv', tolerance=1.0e-9)
+def check_batch():
+    # Summary planets at different Tp0, for every method (verify_batch); 'default' must keep each planet's Tp0
+    planets = []
+    for Tp0, planet in zip((1700.0, 1900.0, 2100.0, 2300.0), summary_planets()):
+        planet['Tp0'] = Tp0
+        planets.append(planet)
+    return max(evolve.verify_batch(planets).values())
+
+@check('check_jit_vs_euler', tolerance=1.0e-9)
+def check_jit():
+    return max(kernel.verify(inputs['planet'], None, method, inputs['planet']['Tp0'], tmax)
+               for method in ('dynamic', 'static', 'default', 'MC'))
+
+@check('check_adaptive_vs_euler', tolerance=5.0e-3)
+def check_adaptive():
+    # LSODA against fixed dt steps: they differ by the Euler loop's truncation error (~1e-3 for temp and Ra)
+    difference = 0.0
+    for method in ('dynamic', 'MC'):
+        planet = inputs['planet']
+        euler = evolve.ThermEv(dict(planet), None, method, planet['Tp0'], tmax, cache=False)
+        adaptive = evolve.ThermEv(dict(planet), None, method, planet['Tp0'], tmax, integrator='adaptive', cache=False)
+        if len(euler) != len(adaptive):
+            return np.inf
+        for column in ('temp', 'Ra'):
+            a, b = euler[column].values, adaptive[column].values
+            difference = max(difference, float(np.max(np.abs(a-b)/np.abs(a))))
+    return difference
+
+@check('check_sweep_vs_ThermEv', tolerance=1.0e-12)
+def check_sweep():
+    # sweep.run against ThermEv, planet by planet: a summary planet for every method, and a bare planet (no Pref,
+    #   no composition) for the methods that never read mixed thermals. A planet the sweep reports failed is inf.
+    bare = {'ID': 'bare', 'Tp0': DEFAULT['Tp0'], 'outcols': list(outcols), 'constants': {}}
+    cases = [(method, summary_planets()[0]) for method in ('dynamic', 'static', 'default', 'MC')]
+    cases += [(method, bare) for method in ('default', 'MC', 'benchmark')]
+    difference = 0.0
+    for method, planet in cases:
+        Evolutions, status = sweep.run([dict(planet)], method=method, workers=1, cache=False)
+        if status['status'].iloc[0] != 'ok':
+            return np.inf
+        usual = evolve.ThermEv(dict(planet), None, method, planet['Tp0'], tmax, cache=False)
+        for column in ('temp', 'Ra', 'Urey'):
+            a, b = usual[column].values.astype(float), Evolutions[column].values.astype(float)
+            difference = max(difference, float(np.max(np.abs(a-b)/np.abs(a))))
+    return difference
+
+@check('check_interpolator_vs_tables', tolerance=1.0e-12)
+def check_interpolator():
+    # ThermalInterpolator against the table lookups it stands in for: the grid interpolator on every (T, P) node
+    #   against thermals_at_P_ave at that P, and Tdep_thermals_batch against Tdep_thermals (on and between T nodes)
+    grid = thermalgrid.load()
+    composition = dict(get.composition_key(inputs['composition']))   # weights as thermals_at_P_ave rounds them
+    T, P = np.meshgrid(grid.T, grid.P, indexing='ij')
+    interpolated = np.stack(grid.interpolator(composition)(T, P)[:3], axis=-1)   # T x P x (alpha, Cp, k)
+    tables = np.stack([get.thermals_at_P_ave(composition, Pj) for Pj in grid.P], axis=1)[:, :, 1:]
+    difference = float(np.max(np.abs(interpolated - tables)/np.abs(tables)))
+    stack = np.stack([get.thermals_at_P_ave(composition, Pj) for Pj in (2.0, 6.0, 25.0, 130.0)])
+    Tp = np.r_[grid.T[[0, 99, 160, -1]], 15.0, 1234.5, 2001.0, 2499.9]
+    for n, table in enumerate(stack):
+        batch = get.Tdep_thermals_batch(stack[[n] * len(Tp)], Tp)
+        for j, T in enumerate(Tp):
+            usual = get.Tdep_thermals(table, T)
+            for prop, value in zip(('alpha', 'Cp', 'k'), batch):
+                difference = max(difference, abs(value[j] - usual[prop])/abs(usual[prop]))
+    return difference
+
+def verify(names=None):
+    # Purpose: runs the selected correctness checks (default: all)
+    # Outputs: dictionary of check name -> (largest relative difference, tolerance, passed)
+    results = {}
+    for name in CHECKS:
+        if names and not any(n in name for n in names):
+            continue
+        function, tolerance = CHECKS[name]
+        with contextlib.redirect_stdout(io.StringIO()):
+            difference = function()
+        results[name] = (difference, tolerance, bool(difference <= tolerance))
+        print(name.ljust(28), format(difference, '10.3g'), '<=' if results[name][2] else '> ', format(tolerance, '.3g'),
+              'ok' if results[name][2] else 'FAILED')
+    return results
+
+def measure(function, repeat):
+    # Purpose: best time of repeat runs, peak traced memory of one more run, and the final values
+    # Outputs: dictionary of seconds, peak_MB, and values
+    with contextlib.redirect_stdout(io.StringIO()):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            values = function()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_MB': peak / 1.0e6, 'values': values}
+
+def compare(result, baseline, threshold, rtol):
+    # Purpose: regressions of one workload against its baseline
+    # Outputs: list of messages, empty if there are none
+    problems = []
+    for key in ('seconds', 'peak_MB'):
+        if result[key] > baseline[key] * (1 + threshold):
+            problems.append(key + ' ' + format(result[key], '.4g') + ' vs ' + format(baseline[key], '.4g'))
+    for key, value in baseline['values'].items():
+        new = result['values'].get(key)
+        if new is None or not np.isclose(new, value, rtol=rtol, atol=0.0):
+            problems.append(key + ' = ' + str(new) + ', was ' + str(value))
+    return problems
+
+def run(names=None, repeat=None):
+    # Purpose: runs the selected workloads (default: all)
+    # Outputs: dictionary of workload name -> measurement
+    with contextlib.redirect_stdout(io.StringIO()):
+        inputs['planet'] = exoplex_planet()
+        inputs['composition'] = inputs['planet']['composition']
+    results = {}
+    for name in WORKLOADS:
+        if names and not any(n in name for n in names):
+            continue
+        function, default_repeat = WORKLOADS[name]
+        results[name] = measure(function, repeat or default_repeat)
+        print(name.ljust(28), format(results[name]['seconds'] * 1000, '10.3f'), 'ms',
+              format(results[name]['peak_MB'], '9.2f'), 'MB')
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the evolution, mineral grid, and ExoPlex hot paths.')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--baseline', default=baselinefile, help='baseline file (default: %(default)s)')
+    parser.add_argument('--only', nargs='*', help='run only workloads whose name contains one of these')
+    parser.add_argument('--repeat', type=int, help='timed repeats per workload (default: per workload)')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown or memory growth, as a fraction')
+    parser.add_argument('--rtol', type=float, default=1.0e-9, help='allowed relative change of final values')
+    args = parser.parse_args()
+
+    results = run(args.only, args.repeat)
+    checked = verify(args.only)
+    wrong = [name for name in checked if not checked[name][2]]
+    if wrong:
+        print('Correctness checks failed:', ', '.join(wrong))
+    if args.save and wrong:
+        print('Not saving a baseline from results that fail their checks.')
+        sys.exit(1)
+    if args.save:
+        saved = {}
+        if os.path.exists(args.baseline) and args.only:
+            with open(args.baseline, 'r') as f:
+                saved = json.load(f)
+        saved.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent=1)
+        print('Saved baseline to', args.baseline)
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print('No baseline at', args.baseline, '- run with --save first.')
+        sys.exit(1 if wrong else 0)
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    failed = bool(wrong)
+    for name in results:
+        if name not in baseline:
+            print(name, ': no baseline')
+            continue
+        problems = compare(results[name], baseline[name], args.threshold, args.rtol)
+        if problems:
+            failed = True
+            print('REGRESSION', name, ':', '; '.join(problems))
+    print('Regressions found.' if failed else 'No regressions.')
+    sys.exit(1 if failed else 0)
@@ -17,6 +17,10 @@ tmax = 4.55  # in Gyr
 dt = 0.01  # in Gyr
 verbose = "false"  # if "true": all print statements activated
 error_tolerance = 1.0e-6
+thermals_cache_size = 256  # mixed thermal tables kept in memory by getall.thermals_at_P_ave
+runcache_size = 200  # MB of finished evolutions kept on disk by runcache.py (oldest used dropped first)
+outcols = ['ID', 'time', 'temp', 'Ra', 'H', 'Q', 'Urey', 'viscT',
+           'visc0', 'Ev', 'log10visc', 'beta']  # evolution output columns, when a planet doesn't list its own
 
 # Default values if nothing is explicitly provided for a parameter:
 DEFAULT = {
@@ -0,0 +1,115 @@
+# A module for space-filling designs over planet parameters.
+# Instead of nested loops over every parameter (whose cost grows exponentially with the number
+# of dimensions), a Latin hypercube or Sobol design covers the whole space with a chosen number
+# of runs, in batches that go straight to evolve.ThermEvBatch.
+# Recommended use, e.g. for the Seales and Lenardic 2019 parameter space (constants.MC):
+#   import design
+#   points = design.sobol(4096, seed=1)
+#   results = design.run(points, method='MC')
+import numpy as np
+import pandas as pd
+import ensemble
+from constants import *
+
+# Bounds of each named parameter: (low, high) or (low, high, 'log') for a log-uniform axis
+SPACE = {
+    'visc0': (1.0e18, 1.0e21, 'log'),
+    'Ev': (250.0e3, 450.0e3),
+    'beta': (0.25, 0.35),
+    'Qpl': (0.5, 2.0),
+    'Tp0': (1700.0, 2300.0),
+    'k': (3.0, 19.0),
+}
+
+# Sobol direction numbers (s, a, m_1..m_s) for dimensions 2 and up, from S. Joe and F. Y. Kuo,
+# new-joe-kuo-6.21201, DOI: 10.1137/070709359. The first dimension uses m_i = 1 throughout.
+JOE_KUO = [(1, 0, [1]), (2, 1, [1, 3]), (3, 1, [1, 3, 1]), (3, 2, [1, 1, 1]), (4, 1, [1, 1, 3, 3]),
+           (4, 4, [1, 3, 5, 13]), (5, 2, [1, 1, 5, 5, 17]), (5, 4, [1, 1, 5, 5, 5]), (5, 7, [1, 1, 7, 11, 19]),
+           (5, 11, [1, 1, 5, 1, 1]), (5, 13, [1, 1, 1, 3, 11]), (5, 14, [1, 3, 5, 5, 31]),
+           (6, 1, [1, 3, 3, 9, 7, 49]), (6, 13, [1, 1, 1, 15, 21, 21]), (6, 16, [1, 3, 1, 13, 27, 49])]
+BITS = 32
+
+def scale(unit, space):
+    # Purpose: maps points in the unit hypercube onto the named parameter bounds
+    # Inputs: (n x d) array in [0, 1); dictionary of bounds, in the same order as the columns
+    # Outputs: DataFrame with one column per parameter
+    columns = {}
+    for j, name in enumerate(space):
+        low, high = space[name][:2]
+        if len(space[name]) > 2 and space[name][2] == 'log':
+            columns[name] = 10.0 ** (np.log10(low) + unit[:, j] * (np.log10(high) - np.log10(low)))
+        else:
+            columns[name] = low + unit[:, j] * (high - low)
+    return pd.DataFrame(columns)
+
+def latin_hypercube(n, space=SPACE, seed=None):
+    # Purpose: Latin hypercube design: each parameter's range is cut into n strata, each sampled exactly once
+    # Inputs: number of points; parameter bounds (see SPACE); seed
+    # Outputs: DataFrame of n points, one column per parameter
+    rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed)))
+    d = len(space)
+    unit = np.empty((n, d))
+    for j in range(d):
+        unit[:, j] = (rng.permutation(n) + rng.uniform(size=n)) / n
+    return scale(unit, space)
+
+def sobol_directions(d):
+    # Purpose: direction integers for the first d Sobol dimensions, as a (d x BITS) array
+    if d > len(JOE_KUO) + 1:
+        raise ValueError('Sobol designs are available for up to ' + str(len(JOE_KUO) + 1) + ' parameters.')
+    V = np.zeros((d, BITS), dtype=np.uint64)
+    V[0] = [1 << (BITS - 1 - k) for k in range(BITS)]
+    for j in range(1, d):
+        s, a, m = JOE_KUO[j - 1]
+        v = [0] * BITS
+        for k in range(BITS):
+            if k < s:
+                v[k] = m[k] << (BITS - 1 - k)
+            else:
+                x = v[k - s] ^ (v[k - s] >> s)
+                for i in range(1, s):
+                    if (a >> (s - 1 - i)) & 1:
+                        x = x ^ v[k - i]
+                v[k] = x
+        V[j] = v
+    return V
+
+def sobol(n, space=SPACE, seed=None, skip=0):
+    # Purpose: Sobol low-discrepancy design
+    # Inputs: number of points (best a power of 2); parameter bounds (see SPACE);
+    #   seed: if given, a random digital shift randomizes the design while keeping its structure;
+    #   skip: number of leading points to skip, e.g. to continue an earlier design
+    # Outputs: DataFrame of n points, one column per parameter
+    # Limitations: up to 16 parameters
+    # Refs: DOI: 10.1016/0041-5553(67)90144-9, DOI: 10.1137/070709359
+    d = len(space)
+    V = sobol_directions(d)
+    index = np.arange(skip, skip + n, dtype=np.uint64)
+    gray = index ^ (index >> np.uint64(1))
+    X = np.zeros((n, d), dtype=np.uint64)
+    for b in range(BITS):
+        bit = ((gray >> np.uint64(b)) & np.uint64(1)).astype(bool)
+        X[bit] ^= V[:, b]
+    if seed is not None:
+        rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed)))
+        X ^= rng.integers(0, 2 ** BITS, size=d, dtype=np.uint64)
+    return scale(X / float(2 ** BITS), space)
+
+def batches(points, size):
+    # Splits a design into consecutive batches of at most size points
+    for start in range(0, len(points), size):
+        yield points.iloc[start:start + size]
+
+def run(points, base=None, method='MC', batch_size=2000, tmax=tmax):
+    # Purpose: evolves every point of a design, batch by batch, keeping each point's final state
+    # Inputs: DataFrame of points (from latin_hypercube or sobol); base planet and thermal method
+    #   (see ensemble.params_for; 'MC' applies constants.MC); points evolved together per batch; end time
+    # Outputs: the points, with final temp, Ra, Urey, and passfail
+    # Limitations: only the first and last step of each history are kept, to save memory on large designs
+    # Calls: batches, ensemble.evolve_samples
+    results = []
+    for batch in batches(points, batch_size):
+        evolved, history = ensemble.evolve_samples(batch, base, method, tmax=tmax, every=int(tmax/dt) + 1,
+                                                   frame=False)
+        results.append(evolved)
+    return pd.concat(results, ignore_index=True)
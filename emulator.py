@@ -0,0 +1,159 @@
+# A module for emulating final states without integrating.
+# A regular grid of training runs (evolved together with evolve.ThermEvBatch) is tabulated once
+# and saved to disk; queries are then multilinear interpolations in that table, vectorized over
+# arrays of parameter points. Each table carries its interpolation error, measured against
+# held-out runs at random points inside the grid.
+# Recommended use:
+#   import emulator
+#   emu = emulator.build()             # once; saved to emulator.npz
+#   emu = emulator.load()
+#   final = emu(Tp0=[1800, 2000], Qpl=1.0, Ev=300e3, visc0=1e19, beta=0.33, Mpl=1.0, k=5.0)
+import os
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import design
+import getall as get
+import thermalgrid
+from constants import *
+
+EMULATOR_VERSION = 1
+here = os.path.dirname(os.path.abspath(__file__))
+emufile = os.path.join(here, 'emulator.npz')
+
+# Training grid: (low, high, nodes) or (low, high, nodes, 'log'), for any parameter design.run accepts.
+# Mpl is paired with an Earth-like radius (get.reasonable_radius with CMF), and k stands in for the
+# mantle's composition, since the constant-property methods ('MC', 'default') see mineralogy only through
+# alpha, Cp, and k, and k varies the most between assemblages.
+AXES = {
+    'Tp0': (1700.0, 2300.0, 5),
+    'Qpl': (0.5, 2.0, 4),
+    'Ev': (250.0e3, 450.0e3, 5),
+    'visc0': (1.0e18, 1.0e21, 5, 'log'),
+    'beta': (0.25, 0.35, 4),
+    'Mpl': (0.5, 3.0, 5),
+    'k': (3.0, 19.0, 5, 'log'),
+}
+OUTPUTS = ['temp', 'Ra', 'Urey']
+CMF = 0.325
+
+def nodes(axis):
+    # Grid nodes of one axis, in the coordinates used for interpolation (log10 for 'log' axes)
+    low, high, n = axis[:3]
+    if len(axis) > 3 and axis[3] == 'log':
+        return np.linspace(np.log10(low), np.log10(high), n)
+    return np.linspace(low, high, n)
+
+def coordinates(axes, points):
+    # Query points, column by column, in interpolation coordinates
+    return [np.log10(np.asarray(points[name], dtype=float)) if len(axes[name]) > 3 and axes[name][3] == 'log'
+            else np.asarray(points[name], dtype=float) for name in axes]
+
+def with_radius(points):
+    # Adds an Earth-like radius for each planet mass, unless radii were given
+    if 'Mpl' in points and 'Rpl' not in points:
+        points = points.copy()
+        points['Rpl'] = get.reasonable_radius(points['Mpl'].values, CMF)
+    return points
+
+def evolve(points, base=None, method='MC', batch_size=2000, tmax=tmax):
+    # Purpose: true final states of the given points, e.g. the training grid or held-out checks
+    # Calls: with_radius, design.run
+    return design.run(with_radius(points), base=base, method=method, batch_size=batch_size, tmax=tmax)
+
+class Emulator:
+    # Purpose: multilinear lookup of final-state outputs on a regular parameter grid
+    # Inputs: axes (as in AXES), table (dictionary of output name -> array shaped by the axes' nodes),
+    #   metadata (method, tmax, base planet, and held-out errors from build)
+    # Outputs: calling it with arrays (or a DataFrame) of every axis parameter returns a DataFrame of outputs,
+    #   plus an 'outside' column flagging points that were clamped to the edge of the grid
+    # Limitations: planets that broke during training leave NaNs, which spread to neighbouring queries;
+    #   accuracy is only as good as the grid spacing, see metadata['errors']
+    # Calls: thermalgrid.bracket
+    def __init__(self, axes, table, metadata=None):
+        self.axes = axes
+        self.grid = [nodes(axes[name]) for name in axes]
+        self.table = table
+        self.metadata = {} if metadata is None else metadata
+
+    def __call__(self, points=None, **parameters):
+        points = parameters if points is None else points
+        x = np.broadcast_arrays(*[np.atleast_1d(c) for c in coordinates(self.axes, points)])
+        index, weight = [], []
+        outside = np.zeros(x[0].shape, dtype=bool)
+        for axis, xi in zip(self.grid, x):
+            i, w, out = thermalgrid.bracket(axis, xi)
+            index.append(i)
+            weight.append(w)
+            outside = outside | out
+        values = {name: np.zeros(x[0].shape) for name in self.table}
+        for corner in itertools.product((0, 1), repeat=len(self.grid)):
+            w = np.ones(x[0].shape)
+            for c, wi in zip(corner, weight):
+                w = w * (wi if c else 1 - wi)
+            at = tuple(i + c for i, c in zip(index, corner))
+            for name in self.table:
+                values[name] = values[name] + w * self.table[name][at]
+        values['outside'] = outside
+        return pd.DataFrame(values)
+
+    def save(self, path=emufile):
+        metadata = dict(self.metadata, version=EMULATOR_VERSION, axes={name: list(self.axes[name]) for name in self.axes})
+        arrays = {'table_' + name: self.table[name] for name in self.table}
+        np.savez(path + '.tmp.npz', metadata=np.array(json.dumps(metadata)), **arrays)
+        os.replace(path + '.tmp.npz', path)   # write-then-rename, as thermalgrid.build
+
+def load(path=emufile):
+    # Purpose: reads an emulator saved by build
+    # Outputs: Emulator
+    with np.load(path, allow_pickle=False) as f:
+        metadata = json.loads(str(f['metadata']))
+        table = {key[len('table_'):]: f[key] for key in f.files if key.startswith('table_')}
+    if metadata.get('version') != EMULATOR_VERSION:
+        raise ValueError(path + ' was built by another version of the emulator; rebuild it with emulator.build().')
+    axes = {name: tuple(metadata['axes'][name]) for name in metadata['axes']}
+    return Emulator(axes, table, metadata)
+
+def validate(emu, n=200, seed=None, base=None, batch_size=2000):
+    # Purpose: interpolation error of an emulator, against true runs at random points inside its grid
+    # Inputs: Emulator; number of held-out points (Latin hypercube over the axes); seed; base planet
+    # Outputs: DataFrame of absolute errors per output (mean, 95th percentile, max), over points that didn't break
+    # Calls: design.latin_hypercube, evolve
+    space = {name: (axis[0], axis[1], 'log') if len(axis) > 3 else (axis[0], axis[1]) for name, axis in emu.axes.items()}
+    points = design.latin_hypercube(n, space, seed=seed)
+    truth = evolve(points, base=base, method=emu.metadata.get('method', 'MC'), batch_size=batch_size,
+                   tmax=emu.metadata.get('tmax', tmax))
+    guess = emu(points)
+    errors = {}
+    for name in emu.table:
+        error = np.abs(guess[name].values - truth[name].values)
+        error = error[np.isfinite(error)]
+        errors[name] = {'mean': float(error.mean()), 'p95': float(np.percentile(error, 95)), 'max': float(error.max())}
+    return pd.DataFrame(errors).T
+
+def build(axes=AXES, base=None, method='MC', outputs=OUTPUTS, batch_size=2000, tmax=tmax,
+          holdout=200, seed=0, path=emufile):
+    # Purpose: evolves every node of the training grid, tabulates the final states, and saves the emulator
+    # Inputs: axes (see AXES); base planet and thermal method (see ensemble.params_for); outputs to tabulate
+    #   (final-state columns of evolve.ThermEvBatch); planets per batch; end time; number of held-out
+    #   validation runs (0 to skip) and their seed; output path (None to skip saving)
+    # Outputs: Emulator, with held-out errors in metadata['errors']
+    # Limitations: the grid holds the product of all node counts (50000 runs for AXES, a few seconds);
+    #   'dynamic' thermals are the base planet's, so k then has no effect
+    # Calls: nodes, evolve, validate
+    mesh = np.meshgrid(*[nodes(axes[name]) for name in axes], indexing='ij')
+    points = pd.DataFrame({name: (10.0 ** m if len(axes[name]) > 3 else m).ravel() for name, m in zip(axes, mesh)})
+    final = evolve(points, base=base, method=method, batch_size=batch_size, tmax=tmax)
+    table = {name: final[name].values.astype(float).reshape(mesh[0].shape) for name in outputs}
+    emu = Emulator(axes, table, {'method': method, 'tmax': tmax, 'runs': len(points),
+                                 'base': {key: value for key, value in (base or {}).items()
+                                          if isinstance(value, (int, float, str))}})
+    if holdout:
+        errors = validate(emu, n=holdout, seed=seed, base=base, batch_size=batch_size)
+        emu.metadata['errors'] = errors.to_dict(orient='index')
+        if verbose == 'true':
+            print(errors)
+    if path is not None:
+        emu.save(path)
+    return emu
@@ -0,0 +1,145 @@
+# A module for Monte Carlo ensembles of rheology and starting conditions.
+# All N samples are drawn at once, from seeded streams that are independent of one another
+# (one per worker), and evolved together with evolve.ThermEvBatch.
+# Recommended use:
+#   import ensemble
+#   samples, envelopes = ensemble.run(10000, seed=42)
+import numpy as np
+import pandas as pd
+import evolve
+import getall as get
+from history import History
+from constants import *
+
+# Prior for each sampled parameter: ('truncnorm', mean, sd, low sd, high sd), ('uniform', low, high),
+# or ('loguniform', low, high). Ev follows getall.TWdepVisc (Jain et al. 2019, OL-WA1, DOI: 10.1089/ast.2017.1695);
+# visc0 is a viscosity at scaletemp (> 1e13 Pa s); Qpl scales the base planet's heat production Qp.
+PRIORS = {
+    'Ev': ('truncnorm', 364.0e3, 61.0e3, -3, 3),
+    'visc0': ('loguniform', 1.0e18, 1.0e21),
+    'beta': ('uniform', 0.25, 0.35),
+    'Qpl': ('uniform', 0.5, 2.0),
+    'Tp0': ('uniform', 1700.0, 2300.0),
+}
+
+def streams(seed, n):
+    # Purpose: n independent, reproducible random generators spawned from one seed
+    return [np.random.Generator(np.random.PCG64(child)) for child in np.random.SeedSequence(seed).spawn(n)]
+
+def draw(n, seed=None, workers=1, priors=PRIORS):
+    # Purpose: draws n samples of every parameter in priors
+    # Inputs: number of samples; seed; workers: number of independent streams, each drawing a contiguous
+    #   chunk of the samples (so each worker of a parallel run can draw its own chunk); priors as in PRIORS
+    # Outputs: DataFrame with one row per sample and one column per parameter
+    # Limitations: the samples depend on seed and workers, not on the order in which chunks are drawn
+    # Calls: streams, get.truncnorm
+    chunks = np.array_split(np.arange(n), workers)
+    samples = {name: np.empty(n) for name in priors}
+    for rng, chunk in zip(streams(seed, workers), chunks):
+        for name in priors:
+            kind, a, b = priors[name][:3]
+            if kind == 'truncnorm':
+                values = get.truncnorm(rng, priors[name][3], priors[name][4], loc=a, scale=b, size=len(chunk))
+            elif kind == 'loguniform':
+                values = 10.0 ** rng.uniform(np.log10(a), np.log10(b), len(chunk))
+            elif kind == 'uniform':
+                values = rng.uniform(a, b, len(chunk))
+            else:
+                raise ValueError('Unknown prior for ' + name + ': ' + str(kind))
+            samples[name][chunk] = values
+    return pd.DataFrame(samples)
+
+def params_for(samples, base=None, method='MC'):
+    # Purpose: ThermEvBatch parameters (and thermals) for each row of samples, on top of one base planet
+    # Inputs: DataFrame of sampled parameters; base planet dictionary (default: DEFAULT); thermal method
+    # Outputs: dictionary of parameter arrays, and the base planet's thermals (None unless method is 'dynamic')
+    # Limitations: Qpl scales the base Qp; Mpl and/or Rpl rebuild the structure (get.build_arrays), the other
+    #   taken from the base planet. Sampled alpha, Cp, or k are overridden by the thermals of 'dynamic' runs.
+    # Calls: evolve.batch_params, get.build_arrays
+    base = dict(DEFAULT) if base is None else base
+    params, tables = evolve.batch_params([base], method)
+    n = len(samples)
+    params = {key: np.repeat(params[key], n) for key in params}
+    for name in samples:
+        if name == 'Qpl':
+            params['Qp'] = params['Qp'] * samples['Qpl'].values
+        else:
+            params[name] = samples[name].values.astype(float)
+    if 'Mpl' in samples or 'Rpl' in samples:
+        Mpl = params['Mpl'] if 'Mpl' in samples else base.get('Mpl', params['Mp'][0]/Me)
+        Rpl = params['Rpl'] if 'Rpl' in samples else base.get('Rpl', base.get('Rp', DEFAULT['Rp'])/Re)
+        params.update(get.build_arrays(Mpl, Rpl))
+    params['ID'] = np.arange(n)
+    thermals = None if tables is None else tables[0]
+    return params, thermals
+
+def percentiles_by_row(values, percentiles):
+    # Purpose: np.nanpercentile(values, percentiles, axis=1), in one sort instead of a loop over rows
+    # Outputs: (percentiles x rows) array; NaN for rows without any values
+    # Refs: linear interpolation between closest ranks, NumPy's default method
+    ordered = np.sort(values, axis=1)   # NaNs sort last
+    valid = np.count_nonzero(~np.isnan(values), axis=1)
+    position = np.asarray(percentiles, dtype=float)[:, None] / 100.0 * np.maximum(valid - 1, 0)[None, :]
+    lo = np.floor(position).astype(int)
+    hi = np.minimum(lo + 1, np.maximum(valid - 1, 0)[None, :])
+    rows = np.arange(len(values))[None, :]
+    a, b, t = ordered[rows, lo], ordered[rows, hi], position - lo
+    with np.errstate(invalid='ignore'):
+        levels = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    return np.where(valid[None, :] > 0, levels, np.nan)
+
+def envelopes(Evolution, columns=('temp', 'Ra', 'Urey'), percentiles=(5, 25, 50, 75, 95)):
+    # Purpose: percentiles across the ensemble, at each time, of the chosen output columns
+    # Inputs: Evolution DataFrame of many runs, or the History of a batch (from ThermEvBatch(..., frame=False))
+    # Outputs: DataFrame indexed by time, with columns such as temp_p5, temp_p50, Ra_p95
+    if isinstance(Evolution, History):
+        times = Evolution.recorded_times()
+    else:
+        times, t_index = np.unique(Evolution['time'].values, return_inverse=True)
+        ID_index, IDs = pd.factorize(Evolution['ID'])
+    bands = {}
+    for column in columns:
+        if isinstance(Evolution, History):
+            wide = Evolution.wide(column)
+        else:
+            wide = np.full((len(times), len(IDs)), np.nan)  # time x sample; planets that broke leave NaNs
+            wide[t_index, ID_index] = Evolution[column].values
+        levels = percentiles_by_row(wide, percentiles)
+        for p, level in zip(percentiles, levels):
+            bands[column + '_p' + str(p)] = level
+    return pd.DataFrame(bands, index=pd.Index(times, name='time'))
+
+def run(n, base=None, method='MC', seed=None, workers=1, priors=PRIORS, tmax=tmax,
+        percentiles=(5, 25, 50, 75, 95), every=1, history=False):
+    # Purpose: Monte Carlo ensemble over diffusion-creep parameters, heat production, and starting Tp
+    # Inputs: number of samples; base planet and thermal method (see params_for); seed and workers (see draw);
+    #   priors; end time; percentiles for the envelopes; every: keep every nth step of the histories;
+    #   history: also return the full evolution of every sample
+    # Outputs: sample table (drawn parameters plus final temp, Ra, Urey, and passfail), and percentile
+    #   envelopes of temperature, Ra, and Urey ratio over time; plus the Evolution DataFrame if history=True
+    # Limitations: without history, envelopes and final states are read from the recorded arrays, and the
+    #   per-step DataFrame of every sample is never built
+    # Calls: draw, evolve_samples, envelopes
+    samples = draw(n, seed=seed, workers=workers, priors=priors)
+    samples, Evolution = evolve_samples(samples, base, method, tmax=tmax, every=every, frame=history)
+    bands = envelopes(Evolution, percentiles=percentiles)
+    if history:
+        return samples, bands, Evolution
+    return samples, bands
+
+def evolve_samples(samples, base=None, method='MC', tmax=tmax, every=1, frame=True):
+    # Purpose: evolves one batch of sampled parameters, and adds each sample's final state to its row
+    # Outputs: samples with final temp, Ra, Urey, and passfail columns; and the Evolution DataFrame,
+    #   or, if frame is False, the batch's History (see evolve.ThermEvBatch)
+    # Calls: params_for, evolve.ThermEvBatch
+    samples = samples.reset_index(drop=True)
+    params, thermals = params_for(samples, base, method)
+    Hts, passfail = evolve.ThermEvBatch(params, thermals, tmax=tmax, every=every, frame=False)
+    for column in ('temp', 'Ra', 'Urey'):
+        samples[column] = Hts.final(column)
+    samples['passfail'] = passfail
+    if not frame:
+        return samples, Hts
+    Evolution = Hts.frame()
+    Evolution['passfail'] = Hts.per_planet(passfail)
+    return samples, Evolution
@@ -1,9 +1,12 @@
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 import getall as get
-import plotly.express as px
 import pandas as pd
 from constants import *
+from history import History
+import profiling
+import runcache
+import thermalgrid
 Pe = lambda n: format(n, '.4e')
 Pf = lambda n: format(n, '.4f')
 
@@ -51,56 +54,366 @@ def flux_heat(planet,Tp,Ra):
             (theta**(-(1+planet['beta'])))*(Ra**(planet['beta'])))
     return Fman
 
-def ThermEv(planet, thermals, method, Tp0, tmax):    
-
-    Tp = Tp0
-    t = 0.0              # Keep Hts=[], Tp=Tp0, and t=0.0 here, so we can reset values and run again.
-    Hts = pd.DataFrame(columns=planet['outcols'])            # A list of lists; column names are in get.keys['columns']
-
+def prepare(planet, thermals, method):
+    # Purpose: readies a planet for a run: applies the method's presets and fills in DEFAULT values
+    # Inputs: planet dictionary (changed in place), thermals, and method, as for ThermEv
+    # Outputs: the thermals to use ('dynamic' runs mix them afresh from planet['composition'] at planet['Pref'],
+    #   or shell by shell from planet['profile'] if planet['Pref'] is 'depth')
+    # Calls: get.thermals_for
     if method =='dynamic':
-        thermals = get.thermals_at_P_ave(planet['composition'],planet['Pref'])    
+        thermals = get.thermals_for(planet)    
     if method=='MC':
         planet.update(MC)
     if method=='default':
         planet.update(DEFAULT)
     if method =='static':
-        thermarray = get.thermals_at_P_ave(planet['composition'],planet['Pref'])
+        thermarray = get.thermals_for(planet)
         tdict ={'alpha': thermarray[int(DEFAULT['scaletemp']/10)-1][1],
                 'Cp': thermarray[int(DEFAULT['scaletemp']/10)-1][2],
                 'k': thermarray[int(DEFAULT['scaletemp']/10)-1][3]} #update(get.Tdep_thermals(thermals,DEFAULT['scaletemp']))    
         planet.update(tdict)
 
-    idefault = []
     for i in DEFAULT.keys(): #make sure all values are populated
         try:
             planet[i]
         except:
             planet[i]=DEFAULT[i]
     #planet['Qp'] = (7.38e-12 * UreyRatio/0.75862069) * np.exp(1.42e-17 * seconds * tmax) * (planet['Mp'] - planet['Mc']) * planet['Qpl']
+    return thermals
 
-    while t <= tmax:
-        if Tp<0:
-            print('Congrats, you broke it! (It happens to the best of us.)')
-            print('Fateful moment:', Pf(t))
-            print('Parameter snapshot:', planet)
-            break
-        if method =='dynamic':
-            planet.update(get.Tdep_thermals(thermals,Tp))
-        planet.update(planet['constants'])
-        viscT=get.viscosity(planet,Tp)
-        Ra=get.rayleigh(planet,Tp,Ts,viscT)
-        production=produce_heat(planet,t)
-        loss=flux_heat(planet,Tp,Ra)
-        dTp=(dt*seconds*(production-loss))/(planet['Cp']*(planet['Mp']-planet['Mc']))
-        line = {'ID': planet['ID'], 'time': t, 'temp': Tp, 'Ra': np.log10(Ra), 'H': production/(1.0e12), 'Q': loss/(1.0e12), 'Urey': production/loss, 'viscT': viscT, 'visc0': np.log10(planet['visc0']), 'Ev': planet['Ev']/1000.0, 'log10visc': np.log10(viscT), 'beta': planet['beta']}
-        Hts=Hts.append(line, ignore_index=True)
-        Tp=Tp+dTp
-        t=t+dt
-
-    Evolution=pd.DataFrame(Hts, columns = planet['outcols'])
+def ThermEv(planet, thermals, method, Tp0, tmax, every=1, integrator='euler', rtol=1.0e-6, jit=False, profile=None,
+            cache=None):    
+    # integrator: 'euler' takes fixed steps of dt (constants.py); 'adaptive' integrates with
+    #   error control (LSODA, which switches to a stiff method when needed) to relative tolerance rtol,
+    #   and records its dense output on the same time grid as 'euler'.
+    # jit: run the 'euler' loop in kernel.euler, compiled by Numba when it is installed (see kernel.verify)
+    # profile: True, or a profiling.Profiler (e.g. with memory=True or a step hook), to time every phase of
+    #   the run; ThermEv then returns (Evolution, report), see profiling.Profiler.report
+    # cache: look the run up in (and add it to) the on-disk runcache; None follows runcache.enabled (off by default).
+    #   Profiled runs always compute afresh.
+    # Per-run invariants are worked out once, in a RunContext; steps read it and never change the planet.
+    if not profile:   # inside a profiling.Profiler block, the run's phases still go to that Profiler
+        if not (runcache.enabled if cache is None else cache):
+            return _ThermEv(planet, thermals, method, Tp0, tmax, every, integrator, rtol, jit, profiling.active)
+        digest = runcache.key(planet, thermals, method, Tp0, tmax, every, integrator, rtol, jit)
+        stored = None if digest is None else runcache.fetch(digest)
+        if stored is not None:
+            Evolution, final = stored
+            planet.update(final)    # as the run would have left it
+            return Evolution
+        Evolution = _ThermEv(planet, thermals, method, Tp0, tmax, every, integrator, rtol, jit, profiling.active)
+        if digest is not None:
+            runcache.store(digest, Evolution, planet)
+        return Evolution
+    profiler = profile if isinstance(profile, profiling.Profiler) else profiling.Profiler()
+    with profiler:
+        Evolution = _ThermEv(planet, thermals, method, Tp0, tmax, every, integrator, rtol, jit, profiler)
+    return Evolution, profiler.report()
+
+def _ThermEv(planet, thermals, method, Tp0, tmax, every, integrator, rtol, jit, profiler):
+    Tp = Tp0
+    t = 0.0              # Keep Tp=Tp0 and t=0.0 here, so we can reset values and run again.
+    Hts = History(tmax, dt, every=every, ID=planet['ID'])    # keeps every nth step; columns are in planet['outcols']
+
+    clock = time.perf_counter()
+    thermals = prepare(planet, thermals, method)
+    context = RunContext(planet, thermals, method)   # invariants of this run, computed once
+    planet.update(planet['constants'])
+    state, record, step = context.state, Hts.record, None
+    if profiler is not None:
+        profiler.add('setup', time.perf_counter() - clock)
+        state, record, step = profiler.state(context), profiler.timed('record', Hts.record), profiler.step
+    clock = time.perf_counter()
+
+    if integrator == 'adaptive':
+        Tp = integrate_adaptive(planet, context, Hts, Tp0, rtol)
+    elif jit:
+        import kernel
+        steps, nsteps, Tp = kernel.euler(np.array(Hts.times), float(Tp0), *kernel.arguments(context))
+        if nsteps < len(Hts.times):
+            broke(planet, Hts.times[nsteps])
+        Hts.record_steps(steps[:nsteps], context.visc0, context.Ev, context.beta)
+    else:
+        while t <= tmax:
+            if Tp<0:
+                broke(planet, t)
+                break
+            viscT, Ra, production, loss, Cp = state(t, Tp)
+            dTp=(dt*seconds*(production-loss))/(Cp*context.Mm)
+            record(t, Tp, Ra, production, loss, viscT, context.visc0, context.Ev, context.beta)
+            if step is not None:
+                step(t, Tp, viscT, Ra, production, loss)
+            Tp=Tp+dTp
+            t=t+dt
+    if method =='dynamic' and Hts.rows > 0:    # leave the planet at its last recorded step, as before
+        planet.update(context.thermals(Hts.data[Hts.rows-1, 1, 0]))
+
+    if profiler is not None:
+        profiler.add('integrate' if integrator == 'adaptive' else 'kernel' if jit else 'steps', time.perf_counter() - clock)
+        profiler.count('steps', Hts.step)
+        clock = time.perf_counter()
+    Evolution=Hts.frame(planet['outcols'])
     Evolution['passfail'] = (np.abs(Tp-1625.0)<50)
+    if profiler is not None:
+        profiler.add('frame', time.perf_counter() - clock)
+    return Evolution
+
+def broke(planet, t):
+    print('Congrats, you broke it! (It happens to the best of us.)')
+    print('Fateful moment:', Pf(t))
+    print('Parameter snapshot:', planet)
+
+def integrate_adaptive(planet, context, Hts, Tp0, rtol):
+    # Purpose: adaptive-step integration of dTp/dt for ThermEv, recorded on the fixed output grid
+    # Inputs: planet dictionary (for messages); RunContext of the run;
+    #   the History to fill (its times are the output grid); starting Tp; relative tolerance
+    # Outputs: Tp one dt past the last output time, as the Euler loop ends
+    # Limitations: Tp reaching 0 ends the run, like a negative Tp in the Euler loop
+    # Calls: scipy.integrate.solve_ivp
+    # Refs: LSODA, doi.org/10.1137/0904010
+    from scipy.integrate import solve_ivp
+
+    def dTpdt(t, y):
+        viscT, Ra, production, loss, Cp = context.state(t, y[0])
+        return [seconds*(production-loss)/(Cp*context.Mm)]
+
+    def frozen(t, y):
+        return y[0]
+    frozen.terminal = True
+    frozen.direction = -1
+
+    tend = Hts.times[-1] + dt
+    sol = solve_ivp(dTpdt, (0.0, tend), [Tp0], method='LSODA', dense_output=True,
+                    rtol=rtol, atol=rtol, events=frozen)
+    if verbose == "true":
+        print('Adaptive integration:', sol.nfev, 'evaluations of dTp/dt')
+    for t in Hts.times:
+        if t > sol.t[-1]:
+            broke(planet, t)
+            break
+        Tp = sol.sol(t)[0]
+        viscT, Ra, production, loss, Cp = context.state(t, Tp)
+        Hts.record(t, Tp, Ra, production, loss, viscT, context.visc0, context.Ev, context.beta)
+    return sol.y[0, -1]
+
+class RunContext:
+    # Purpose: everything about one ThermEv run that doesn't change from step to step, worked out once
+    # Inputs: planet dictionary, prepared as ThermEv prepares it (method presets and DEFAULT filled in);
+    #   thermals (T-dependent table, used when method is 'dynamic'); method
+    # Outputs: state(t, Tp), returning viscT, Ra, heat production, heat loss, and Cp at that step
+    # Limitations: reads the planet once; later changes to the dictionary don't reach the run. Nothing is
+    #   written back while stepping, so one context can serve several threads at once.
+    # Calls: n/a
+    # Refs: as get.viscosity, get.rayleigh, produce_heat, and flux_heat
+    __slots__ = ('table', 'columns', 'gap', 'fixed', 'alpha', 'Cp', 'k', 'Mm', 'pm', 'g', 'd', 'Sa', 'Ts', 'Ev', 'visc0',
+                 'scaletemp', 'beta', 'c1', 'Qp', 'decay', 'Q0', 'visc_offset', 'visc_scale',
+                 'buoyancy', 'conduction', 'theta_exponent', 'isotopes')
+
+    def __init__(self, planet, thermals, method):
+        p = dict(planet)
+        constants = p.get('constants', {})
+        p.update(constants)
+        self.table = np.asarray(thermals, dtype=float) if method == 'dynamic' else None
+        if self.table is not None:   # plain lists: indexing them per step is cheaper than indexing arrays
+            self.columns = tuple(self.table[:, c].tolist() for c in range(4))
+            self.gap = self.columns[0][1] - self.columns[0][0]
+        self.fixed = {prop: p[prop] for prop in ('alpha', 'Cp', 'k') if prop in constants}
+        self.alpha, self.Cp, self.k = float(p['alpha']), float(p['Cp']), float(p['k'])
+        for key in ('pm', 'g', 'd', 'Sa', 'Ts', 'Ev', 'visc0', 'scaletemp', 'beta', 'c1', 'Qp'):
+            setattr(self, key, float(p[key]))
+        self.decay = float(p['decay']) if 'decay' in p else None
+        self.Q0 = float(p['Q0']) if 'Q0' in p else None
+        self.Mm = float(p['Mp'] - p['Mc'])
+        # viscosity branch: visc0 >= 1e13 is a viscosity at scaletemp, anything less an unscaled prefactor
+        self.visc_offset = self.Ev/(R*self.scaletemp) if self.visc0 >= 1.0e13 else 0.0
+        self.visc_scale = self.visc0 * np.exp(self.Ev/(R*self.scaletemp) - self.visc_offset)
+        self.buoyancy = (self.pm ** 2) * self.g * (self.d ** 3)
+        self.conduction = self.Sa * self.c1 / self.d
+        self.theta_exponent = -(1 + self.beta)
+        self.isotopes = tuple(zip(radio[0] * radio[1], -radio[2]))
+
+    def properties(self, Tp):
+        # alpha, Cp, and k at Tp, with planet['constants'] held fixed; interpolated as get.Tdep_thermals
+        if self.table is None:
+            return self.alpha, self.Cp, self.k
+        T, alpha, Cp, k = self.columns
+        i = min(max(int(np.floor(Tp/self.gap))-1, 0), len(T)-2)
+        hi_wt = (Tp-T[i])/(T[i + 1]-T[i])
+        lo_wt = (T[i + 1]-Tp)/(T[i + 1]-T[i])
+        fixed = self.fixed
+        return (self.alpha if 'alpha' in fixed else alpha[i] * lo_wt + alpha[i + 1] * hi_wt,
+                self.Cp if 'Cp' in fixed else Cp[i] * lo_wt + Cp[i + 1] * hi_wt,
+                self.k if 'k' in fixed else k[i])
+
+    def thermals(self, Tp):
+        alpha, Cp, k = self.properties(Tp)
+        return {'alpha': alpha, 'Cp': Cp, 'k': k}
+
+    def viscosity(self, Tp):
+        return self.visc0 * np.exp(self.Ev/(R * Tp) - self.visc_offset)
+
+    def rayleigh(self, Tp, alpha, Cp, k, viscT):
+        return self.buoyancy * alpha * (Tp-Ts) * Cp/(k * viscT)
+
+    def production(self, t):
+        if self.decay is not None:
+            return self.Qp * np.exp(-1*self.decay*t)
+        return self.Qp * sum(weight * np.exp(rate * t) for weight, rate in self.isotopes)
+
+    def loss(self, Tp, k, Ra, viscT):
+        if self.Q0 is not None:
+            return self.Q0 * (Tp / self.scaletemp)**(1 + self.beta) * (self.visc_scale / viscT)**(self.beta)
+        theta = frank_kamenetskii(self.Ev, Tp)
+        return self.conduction*k*(Tp-self.Ts)*(theta**self.theta_exponent)*(Ra**(self.beta))
+
+    def state(self, t, Tp):
+        alpha, Cp, k = self.properties(Tp)
+        viscT = self.viscosity(Tp)
+        Ra = self.rayleigh(Tp, alpha, Cp, k, viscT)
+        return viscT, Ra, self.production(t), self.loss(Tp, k, Ra, viscT), Cp
+
+BATCH_KEYS = ['Tp0', 'Mp', 'Mc', 'alpha', 'Cp', 'k', 'pm', 'g', 'd', 'Sa', 'Ts',
+              'Ev', 'visc0', 'scaletemp', 'beta', 'c1', 'Qp', 'decay', 'Q0']
+
+def batch_params(planets, method):
+    # Purpose: collects planet dictionaries into the parameter arrays that ThermEvBatch evolves
+    # Inputs: list of planet dictionaries (as passed to ThermEv), and the thermal method to apply to all of them
+    # Outputs: dictionary of arrays, one entry per BATCH_KEYS name plus 'ID'; and the thermals to use:
+    #   None, or a stack of per-planet T-dependent tables when method is 'dynamic'
+    # Limitations: planets are copied, so unlike ThermEv, the input dictionaries are left untouched.
+    #   Properties a planet holds in planet['constants'] are written into its own table, so they stay fixed.
+    # Calls: get.thermals_for_many (which mixes every distinct composition and Pref in one batch)
+    # Tasks: n/a
+    # Refs: n/a
+    rows = []
+    tables = []
+    prepared = []
+    for planet in planets:
+        p = dict(planet)
+        if method == 'MC':
+            p.update(MC)
+        if method == 'default':
+            p.update(DEFAULT)
+            if 'Tp0' in planet:   # the preset's Tp0 would replace the planet's; ThermEv takes Tp0 separately
+                p['Tp0'] = planet['Tp0']
+        prepared.append(p)
+    thermarrays = get.thermals_for_many(prepared) if method in ('static', 'dynamic') else [None] * len(prepared)
+    for p, thermarray in zip(prepared, thermarrays):
+        if method == 'static':
+            iT = int(DEFAULT['scaletemp']/10)-1
+            p.update({'alpha': thermarray[iT][1], 'Cp': thermarray[iT][2], 'k': thermarray[iT][3]})
+        for i in DEFAULT.keys():
+            if i not in p:
+                p[i] = DEFAULT[i]
+        p.update(p.get('constants', {}))
+        if method == 'dynamic':
+            table = np.array(thermarray, dtype=float)
+            for column, prop in ((1, 'alpha'), (2, 'Cp'), (3, 'k')):
+                if prop in p.get('constants', {}):
+                    table[:, column] = p[prop]
+            tables.append(table)
+        rows.append(p)
+    params = {key: np.array([p.get(key, np.nan) for p in rows], dtype=float) for key in BATCH_KEYS}
+    params['ID'] = np.array([p.get('ID', n) for n, p in enumerate(rows)], dtype=object)
+    thermals = np.stack(tables) if tables else None
+    return params, thermals
+
+def ThermEvBatch(params, thermals=None, tmax=tmax, outcols=outcols, every=1, frame=True):
+    # Purpose: evolves many planets in lockstep, with the same physics and time stepping as ThermEv
+    # Inputs: dictionary (or DataFrame) of planet parameters named as in BATCH_KEYS, each an array of
+    #   length n or a scalar shared by all planets. Missing parameters take DEFAULT values, except 'decay'
+    #   and 'Q0': a NaN there selects the 4-isotope heat production and the naive heat flux, as in ThermEv.
+    #   thermals: None (use alpha, Cp, k from params), one (nT x 4) table, or (n x nT x 4) tables.
+    #   every: keep every nth step of the history (the final step is always kept)
+    # Outputs: DataFrame holding every planet's evolution one after another, columns as in outcols plus passfail;
+    #   or, if frame is False, the History (read with History.wide and History.final) and each planet's passfail,
+    #   which skips building the DataFrame
+    # Limitations: a planet whose Tp drops below 0 stops recording at that step, the others carry on
+    # Calls: get.Tdep_thermals_batch, ThermalInterpolator.from_tables
+    # Tasks: n/a
+    # Refs: n/a
+    if 'ID' in params:
+        n = len(params['ID'])
+    else:
+        n = np.broadcast(*[np.asarray(params[key]) for key in BATCH_KEYS if key in params]).size
+    p = {}
+    for key in BATCH_KEYS:
+        value = params[key] if key in params else DEFAULT.get(key, np.nan)
+        p[key] = np.broadcast_to(np.asarray(value, dtype=float), (n,))
+    IDs = np.asarray(params['ID'], dtype=object) if 'ID' in params else np.arange(n)
+    if thermals is not None:   # located afresh each step, but built once
+        thermals = thermalgrid.ThermalInterpolator.from_tables(thermals)
+
+    scaled = p['visc0'] >= 1.0e13
+    visc_offset = np.where(scaled, p['Ev']/(R*p['scaletemp']), 0.0)
+    use_Q0 = ~np.isnan(p['Q0'])
+    use_decay = ~np.isnan(p['decay'])
+    Mm = p['Mp'] - p['Mc']
+    alpha, Cp, k = p['alpha'], p['Cp'], p['k']
+    Hts = History(tmax, dt, every=every, ID=IDs, n=n)   # steps are the same as ThermEv's
+    broken = np.zeros(n, dtype=bool)
+
+    Tp = p['Tp0'].copy()
+    with np.errstate(all='ignore'):  # broken planets keep computing garbage until they're masked out
+        for t in Hts.times:
+            newly = (Tp < 0) & ~broken
+            if newly.any():
+                Hts.stop(newly)
+                broken |= newly
+                print('Congrats, you broke', int(newly.sum()), 'planet(s)! (It happens to the best of us.)')
+                print('Fateful moment:', Pf(t))
+                if broken.all():
+                    break
+            if thermals is not None:
+                alpha, Cp, k = get.Tdep_thermals_batch(thermals, Tp)
+            viscT = p['visc0'] * np.exp(p['Ev']/(R*Tp) - visc_offset)
+            Ra = (p['pm'] ** 2) * p['g'] * alpha * (Tp-Ts) * (p['d'] ** 3) * Cp/(k * viscT)
+            Ht = sum(radio[0,i] * radio[1,i] * np.exp(radio[2,i] * (-1*t)) for i in range(4))
+            production = np.where(use_decay, p['Qp'] * np.exp(-1*p['decay']*t), p['Qp'] * Ht)
+            theta = frank_kamenetskii(p['Ev'], Tp)
+            loss = p['Sa']*(p['c1']*k*(Tp-p['Ts'])/p['d']*(theta**(-(1+p['beta'])))*(Ra**(p['beta'])))
+            if use_Q0.any():
+                visc_scale = p['visc0'] * np.exp(p['Ev']/(R*p['scaletemp']) - visc_offset)
+                Q0_loss = (p['Q0'] * (Tp/p['scaletemp'])**(1 + p['beta']) * (visc_scale/viscT)**(p['beta']))
+                loss = np.where(use_Q0, Q0_loss, loss)
+            dTp = (dt*seconds*(production-loss))/(Cp*Mm)
+            Hts.record(t, Tp, Ra, production, loss, viscT, p['visc0'], p['Ev'], p['beta'])
+            Tp = np.where(broken, Tp, Tp+dTp)
+
+    passfail = np.abs(Tp-1625.0)<50
+    if not frame:
+        return Hts, passfail
+    Evolution = Hts.frame(outcols)
+    Evolution['passfail'] = Hts.per_planet(passfail)
     return Evolution
 
+def verify_batch(planets, methods=('dynamic', 'static', 'default', 'MC'), tmax=tmax,
+                 columns=('temp', 'Ra', 'H', 'Q', 'viscT')):
+    # Purpose: compares ThermEvBatch against ThermEv, run planet by planet, for each method
+    # Inputs: list of planet dictionaries with distinct IDs, each starting at planet['Tp0'] (copied for every run)
+    # Outputs: dictionary of method -> largest relative difference over the given output columns
+    #   (inf if a planet's histories differ in length)
+    # Calls: batch_params, ThermEvBatch, ThermEv
+    found = {}
+    for method in methods:
+        params, thermals = batch_params(planets, method)
+        batch = ThermEvBatch(params, thermals, tmax)
+        difference = 0.0
+        for planet in planets:
+            usual = ThermEv(dict(planet), None, method, planet['Tp0'], tmax, cache=False)
+            mine = batch[batch['ID'] == planet['ID']]
+            if len(usual) != len(mine):
+                difference = np.inf
+                break
+            for column in columns:
+                a, b = usual[column].values.astype(float), mine[column].values.astype(float)
+                with np.errstate(all='ignore'):
+                    difference = max(difference, float(np.nanmax(np.abs(a-b)/np.maximum(np.abs(a), 1.0e-300))))
+        found[method] = difference
+    if verbose == "true":
+        print('ThermEvBatch against ThermEv - max relative difference:', found)
+    return found
+
 
 # low_mg = {'C2/c':0.02553006, 'Wus':0.000000, 'Pv':0.40009268, 'an':0.00, \
 #                'O':0.00000, 'Wad':0.00000, 'Ring':0.00000, 'Opx':0.06821423, \
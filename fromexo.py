@@ -1,5 +1,11 @@
+import os
+import json
+import glob
+import hashlib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import getall as get
+import profiling
 from mineralDB import minerals
 import pandas as pd
 from constants import *
@@ -7,191 +13,405 @@ from constants import *
 Pe = lambda n: format(n, '.4e')
 Pf = lambda n: format(n, '.4f')
 
-def planets_from_summary():
-	# Purpose: Imports a tidy-format file containing all necessary (and any optional 
+@profiling.profiled()
+def planets_from_summary(file='cumulative.csv', filters=None, cache=True):
+    # Purpose: Imports a tidy-format file containing all necessary (and any optional 
     #    e.g. mineral) planetary parameters. Enables users to run planets in batch.
     # Inputs: CSV file, without headers. Each line has format of: PlanetID,Parameter,Value
     # Required parameters: alpha, CMBP, CMF, Cp, CRF, Mantle_depth, Mantle_mass, Mantle_rho, Mantle_vol,
         # Mass_kg, Mass_Me, Radius_m, Radius_Re ... minerals are optional, any # of mins works for a given ID
         # but the mineral abbreviation must match those in mineralDB.py, and end in '_percent' (e.g. Cpx_percent)
+    #   filters and cache: as for load_summary; only planets that pass the filters are returned
     # Outputs: a nested dictionary whose keys are the planet IDs; each planet is a dict with parameters from file.
     # Limitations: Formatting is specific, needs all params. See default cumulative.csv for sample formatting.
-    # Calls: none
+    # Calls: load_summary
     # Tasks: Couple with get.build function to populate parameters for planets with missing parameters.
     # Refs: n/a
-	file = 'cumulative.csv'
-	f = open(file,'r')
-	lines = f.readlines()
-	f.close()
-	files = {}
-	for line in lines:
-		temp = line.split(',')
-		if temp[0] not in files:
-			files[temp[0]] = {}
-		files[temp[0]][temp[1]] = float(temp[2])
-
-	for file in files:
-		files[file]['composition'] = {}
-		for mineral in minerals.keys():
-			if (mineral in files[file]) and (files[file][mineral]>0):
-					files[file]['composition'][mineral] = files[file][mineral]
-			try:
-				del files[file][mineral]
-			except KeyError:
-				pass
-		files[file]['composition'] = get.adds_up(files[file]['composition'])
-		# print("\n" + file + "\n" + "\n".join("{}: {}".format(k, v) for k, v in files[file]['composition'].items()) + "}")
-	return(files)
+    table, composition = load_summary(file, filters, cache)
+    names, phases = list(table.columns), list(composition.columns)
+    complete = ~np.isnan(table.values).any(axis=1)
+    files = {}
+    for ID, values, full, fractions in zip(table.index, table.values.tolist(), complete, composition.values.tolist()):
+        planet = dict(zip(names, values)) if full else {n: v for n, v in zip(names, values) if v == v}  # v == v: not NaN
+        planet['composition'] = {m: f for m, f in zip(phases, fractions) if f > 0}
+        files[ID] = planet
+    return files
+
+def load_summary(file='cumulative.csv', filters=None, cache=True):
+    # Purpose: reads a tidy PlanetID,Parameter,Value file (as planets_from_summary) into typed, wide tables
+    # Inputs: file; filters: applied to the wide table before anything per planet is built - a dictionary of
+    #   column -> (low, high) range (either end None for open), list of allowed values, or single value
+    #   ('ID' selects planets by name), e.g. {'Mass_Me': (0.5, 2.0), 'SiMg': (None, 0.9)}; or a function of
+    #   the table returning a boolean mask; cache: keep the wide table in the parsed-profile store next to file
+    #   (.exoplex_cache/), and reuse it until file changes
+    # Outputs: table (DataFrame indexed by planet ID, one float column per non-mineral parameter, NaN where a
+    #   planet doesn't give it), and composition (DataFrame indexed by the same IDs, one column per mineralDB
+    #   mineral found in file, in mineralDB's order; weight fractions normalized as get.adds_up normalizes them)
+    # Limitations: repeated (ID, Parameter) lines keep the last value, as planets_from_summary always did
+    # Calls: read_summary, select
+    IDs, parameters, values = read_summary(file, cache)
+    wide = pd.DataFrame(values, index=pd.Index(IDs, name='ID'), columns=parameters)
+    wide = select(wide, filters)
+    mineral_columns = [m for m in minerals.keys() if m in wide.columns]
+    table = wide.drop(columns=mineral_columns)
+    amounts = np.nan_to_num(wide[mineral_columns].values)
+    amounts[amounts <= 0] = 0.0
+    subtotal = amounts.sum(axis=1)
+    rescale = (np.abs(subtotal - 1.0) > error_tolerance) & (subtotal != 0)   # as get.adds_up
+    amounts[rescale] = amounts[rescale] / subtotal[rescale, None]
+    composition = pd.DataFrame(amounts, index=wide.index, columns=mineral_columns)
+    return table, composition
+
+def select(table, filters):
+    # The rows of a wide summary table that pass load_summary's filters
+    if filters is None:
+        return table
+    if callable(filters):
+        return table[np.asarray(filters(table), dtype=bool)]
+    keep = np.ones(len(table), dtype=bool)
+    for column, rule in filters.items():
+        values = table.index.values if column == 'ID' else table[column].values
+        if isinstance(rule, tuple):
+            low, high = rule
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+        elif isinstance(rule, (list, set, np.ndarray)):
+            keep &= np.isin(values, list(rule))
+        else:
+            keep &= values == rule
+    return table[keep]
+
+def read_summary(file, cache=True):
+    # Purpose: the tidy file as one wide array, from the store if it is still current
+    # Outputs: planet IDs (in order of first appearance), parameter names (likewise), and (planets x parameters)
+    #   float array with NaN for missing values
+    st = os.stat(file)
+    entry = os.path.join(os.path.dirname(os.path.abspath(file)), storename,
+                         os.path.basename(file) + '.summary.npz')
+    signature = np.array([STORE_VERSION, st.st_size, st.st_mtime_ns], dtype=np.int64)
+    if cache and os.path.exists(entry):
+        with np.load(entry) as npz:
+            if np.array_equal(npz['signature'], signature):
+                return npz['IDs'].tolist(), npz['parameters'].tolist(), npz['values']
+    tidy = pd.read_csv(file, header=None, names=['ID', 'Parameter', 'Value'], dtype={'ID': str, 'Parameter': str},
+                       float_precision='round_trip')
+    tidy = tidy.drop_duplicates(['ID', 'Parameter'], keep='last')
+    rows, IDs = pd.factorize(tidy['ID'])
+    columns, parameters = pd.factorize(tidy['Parameter'])
+    values = np.full((len(IDs), len(parameters)), np.nan)
+    values[rows, columns] = tidy['Value'].values.astype(float)
+    IDs, parameters = list(IDs), list(parameters)
+    if cache:
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            np.savez(entry + '.tmp.npz', signature=signature, IDs=np.array(IDs), parameters=np.array(parameters),
+                     values=values)
+            os.replace(entry + '.tmp.npz', entry)
+        except OSError:   # read-only folder: parse afresh next time
+            pass
+    return IDs, parameters, values
+
+def summary_planet(entry, ID, Tp0=DEFAULT['Tp0'], Qpl=1.0, Pref=5.0, constants=None):
+    # Purpose: turns one entry of planets_from_summary into a planet dictionary ready for evolve.ThermEv
+    # Inputs: the entry (dictionary of summary parameters plus 'composition'), its ID, starting Tp,
+    #   relative heat production, reference pressure, and the parameters to hold constant (default: beta=0.3)
+    # Outputs: planet dictionary, structured as in the composition-comparison workflow of ExoEvo.ipynb
+    # Calls: get.CMB_T, get.adds_up
+    planet = {'ID': ID, 'Mpl': entry['Mass_Me'], 'Rpl': entry['Radius_Re'], 'Qpl': Qpl, 'Tp0': Tp0}
+    planet['constants'] = {'beta': 0.3} if constants is None else dict(constants)
+    planet['outcols'] = list(outcols)
+    planet['Mp'] = entry['Mass_kg']
+    planet['Mc'] = planet['Mp'] * entry['CMF']
+    planet['Rp'] = entry['Radius_m']
+    planet['Rc'] = planet['Rp'] * entry['CRF']
+    planet['d'] = entry['Mantle_depth']
+    planet['Vm'] = entry['Mantle_vol']
+    planet['Sa'] = 4 * np.pi * planet['Rp']**2
+    planet['pm'] = entry['Mantle_rho']
+    planet['g'] = Grav * planet['Mp']/(planet['Rp']**2)
+    planet['Pcmb'] = entry['CMBP']
+    planet['Tcmb'] = get.CMB_T(planet['Rp'], planet['Tp0'])
+    planet['Pref'] = Pref
+    planet['composition'] = get.adds_up(dict(entry['composition']))
+    planet['c1'], planet['Ev'], planet['visc0'] = DEFAULT['c1'], DEFAULT['Ev'], DEFAULT['visc0']
+    return planet
 
 def read_cols(file):
 	f=open(file,'r')
-	lines=f.readlines()[0].split(separator)
+	lines=f.readline().split(separator)
+	f.close()
 	lines[0]=lines[0][1:] #removes comment character from header
-	lines[-1]=lines[-1][0:-1] #removes newline character 
+	lines[-1]=lines[-1].rstrip('\n') #removes newline character 
 	return lines
 
-def weights_by_volume(file,startline):
+class ExoPlexProfile:
+    # Purpose: one ExoPlex output file, parsed once into NumPy columns
+    # Inputs: path to an ExoPlex CSV (header line starting with '#', one row per radial shell, center first)
+    # Attributes: columns (names from the header), data (rows x columns array), index (name -> column),
+    #   cmb (row where the mantle starts, found from the file rather than assumed), minerals (phase columns)
+    # Limitations: units as written by ExoPlex: km, g/cm^3, GPa, K; mineral abundances in wt %
+    # Refs: ExoPlex, github.com/CaymanUnterborn/ExoPlex
+    def __init__(self, file, columns=None, data=None):
+        self.file = file
+        if data is None:  # columns and data are given when the profile comes from a parsed-profile store
+            columns = read_cols(file)
+            data = pd.read_csv(file, sep=separator).values.astype(float)
+        self.columns = list(columns)
+        self.data = data
+        self.index = {name: i for i, name in enumerate(self.columns)}
+        self.minerals = self.columns[11:-2]  # Excludes iron phase and mass
+        self.cmb = self.find_cmb()
+
+    def column(self, name, start=0):
+        return self.data[start:, self.index[name]]
+
+    def find_cmb(self):
+        # First shell with mantle material: no core iron, and thermodynamic properties populated
+        mantle = self.column('Cp') > 0
+        if 'Fe' in self.index:
+            mantle = mantle & (self.column('Fe') == 0)
+        if not mantle.any():
+            raise ValueError('No mantle shells found in ' + str(self.file))
+        return int(np.argmax(mantle))
+
+    def weights_by_volume(self, start=None):
+        # Returns: radius of each shell boundary (m), relative contribution of each boundary to the shell
+        #   between it and the next (by surface area), and each shell's fraction of the total volume
+        start = self.cmb if start is None else start
+        R = self.column('Radius', start) * 1000  # converts to meters
+        SA = 4 * np.pi * R ** 2
+        V = (4. / 3.) * np.pi * R ** 3
+        vol_weights = np.column_stack((SA[:-1], SA[1:])) / (SA[:-1] + SA[1:])[:, None]
+        fraction_of_volume = np.diff(V) / (V.max() - V.min())
+        return R, vol_weights, fraction_of_volume
+
+    def weights_by_mass(self, start=None):
+        # Returns: mass of each shell (kg), relative contribution of each boundary to its shell's mass,
+        #   and each shell's fraction of the total mass
+        start = self.cmb if start is None else start
+        R, vol_weights, fraction_of_volume = self.weights_by_volume(start)
+        Vtot = (4. / 3.) * np.pi * (R.max() ** 3 - R.min() ** 3)
+        rho = self.column('Density', start) * 1000  # converts to kg/m3
+        rho_rel = np.column_stack((rho[:-1], rho[1:])) / (rho[:-1] + rho[1:])[:, None]
+        mass_weights = rho_rel * vol_weights
+        mass_weights = mass_weights / mass_weights.sum(axis=1)[:, None]
+        rho_avg = vol_weights[:, 0] * rho[:-1] + vol_weights[:, 1] * rho[1:]  # volumetric average for density itself
+        shellmasses = rho_avg * fraction_of_volume * Vtot
+        return shellmasses, mass_weights, shellmasses / shellmasses.sum()
+
+    def average(self, by='mass', start=None):
+        # Returns: every column averaged over the shells from start (default: the core-mantle boundary)
+        #   up to the surface, weighted by mass or by volume
+        start = self.cmb if start is None else start
+        if by == 'mass':
+            weights, fractions = self.weights_by_mass(start)[1:]
+        else:
+            weights, fractions = self.weights_by_volume(start)[1:]
+        rows = self.data[start:]
+        return (fractions * weights[:, 0]) @ rows[:-1] + (fractions * weights[:, 1]) @ rows[1:]
+
+    def bulk_mass_fraction(self, start=None):
+        average = self.average('mass', start)
+        return dict(zip(self.minerals, 0.01 * average[11:-2]))
+
+    def structure(self, planet):
+        # Adds the planet's structure (radii, masses, mantle volume and density, gravity, CMB conditions)
+        cmb = self.data[self.cmb]
+        planet['Rp'] = self.data[0, self.index['Depth']] * 1000
+        planet['Rpl'] = planet['Rp'] / Re
+        planet['Tcmb'] = get.CMB_T(planet['Rp'], planet['Tp0'])
+        planet['Sa'] = 4 * np.pi * planet['Rp'] ** 2
+        planet['Rc'] = cmb[self.index['Radius']] * 1000
+        planet['d'] = planet['Rp'] - planet['Rc']
+        planet['Vm'] = (4. / 3.) * np.pi * (planet['Rp'] ** 3 - planet['Rc'] ** 3)
+        planet['Pcmb'] = cmb[self.index['Pressure']]
+        planet['Mc'] = cmb[self.index['Mass']]
+        planet['Mp'] = self.data[-1, self.index['Mass']]
+        planet['pm'] = (planet['Mp'] - planet['Mc']) / planet['Vm']
+        planet['g'] = Grav * planet['Mp'] / (planet['Rp'] ** 2)
+        planet['CMF'] = planet['Mc'] / planet['Mp']
+        planet['CRF'] = planet['Rc'] / planet['Rp']
+        return planet
+
+    def thermals(self, planet, start=None, upper=100):
+        # Adds volume-averaged alpha, mass-averaged Cp, and k from the Vp of the uppermost shells
+        V_average = self.average('volume', start)
+        M_average = self.average('mass', start)
+        UM_average = self.average('volume', len(self.data) - upper)
+        planet['k'] = 0.0681 * np.exp(0.0006 * UM_average[self.index['Vp']] * 1000.0)
+        planet['alpha'] = V_average[self.index['Alpha']]
+        planet['Cp'] = M_average[self.index['Cp']]
+        return planet
+
+_profiles = {}
+
+@profiling.profiled()
+def load_profile(file):
+    # Purpose: returns the ExoPlexProfile for file, parsing it only if it is new or has changed on disk
+    st = os.stat(file)
+    key = (os.path.abspath(file), st.st_size, st.st_mtime_ns)
+    profile = _profiles.get(key)   # one lookup, so a clear from another thread can't intervene
+    if profile is None:
+        if len(_profiles) > 16:
+            _profiles.clear()
+        profile = _profiles[key] = ExoPlexProfile(file)
+        if profiling.active is not None:
+            profiling.active.count('ExoPlex files parsed')
+    return profile
+
+def weights_by_volume(file,startline=None):
 	#returns: radius of each shell, relative contribution of each depth
-	f=open(file,'r')					# vs the one following it, relative contribution of each shell to volume 
-	lines=f.readlines()[startline:]
-	f.close()
-	radii=[]
-	surfa=[]
-	vol_cumul=[]
-	weight_local=[]
-	fraction_of_volume=[]
-	count=0
-	for line in lines:
-		temp=line.split(separator)
-		R=float(temp[1])*1000 #converts to meters
-		SA=4*np.pi*R**2
-		V=(4./3.)*np.pi*R**3
-		radii.append(R)
-		surfa.append(SA)
-		vol_cumul.append(V)
-	Vtot=max(vol_cumul)-min(vol_cumul)
-	for i in range(len(radii)-1):
-		SA1=surfa[i]/(surfa[i]+surfa[i+1])
-		SA2=surfa[i+1]/(surfa[i]+surfa[i+1])
-		Vsh=(vol_cumul[i+1]-vol_cumul[i])
-		weight_local.append([SA1,SA2])
-		fraction_of_volume.append(Vsh/Vtot)
-	vol_weights=np.asarray(weight_local)
-	return radii, vol_weights, fraction_of_volume
-
-def weights_by_mass(file,startline):
+	# vs the one following it, relative contribution of each shell to volume 
+	return load_profile(file).weights_by_volume(startline)
+
+def weights_by_mass(file,startline=None):
 	#returns: mass of each shell, relative contribution of each depth to mass, relative contribution of each shell to mass
-	radii, weight_local, weight_total = weights_by_volume(file,startline)
-	Vtot=(4./3.)*np.pi*(max(radii)**3 - min(radii)**3)
-	f=open(file,'r')	
-	lines=f.readlines()[startline:]
-	f.close()
-	densi=[]
-	shellmasses=[]
-	weight_masses=[]
-	fraction_of_mass=[]
-	count=0
-	for line in lines:
-		temp=line.split(separator)
-		rho=float(temp[2])*1000 #converts to kg/m3
-		densi.append(rho)
-	for i in range(len(weight_local[:,0])-1):
-		rho1=densi[i]/(densi[i]+densi[i+1]) # radius 1 contains this much (more/less) mass per m3 than radius 2
-		rho2=densi[i+1]/(densi[i]+densi[i+1]) # note that weight_local indicates this much (more/less) volume.
-
-		mass_sum=rho1*weight_local[i,0] + rho2*weight_local[i,1]
-		M1=rho1*weight_local[i,0] / mass_sum  # normalized contribution to total mass of shell, for calculating
-		M2=rho2*weight_local[i,1] / mass_sum # how to weigh each mass percent
-		weight_masses.append([M1,M2])
-
-		rho_avg=(weight_local[i,0]*densi[i])+(weight_local[i,1]*densi[i+1]) # volumetric average for density itself
-		shellmasses.append(rho_avg*(weight_total[i]*Vtot))
-	totalmass=sum(shellmasses)
-	for i in range(len(shellmasses)):
-		fraction_of_mass.append(shellmasses[i]/totalmass)
-	return shellmasses, weight_masses, fraction_of_mass
+	return load_profile(file).weights_by_mass(startline)
 
 def find_average(file,startline,relative_fractions,fraction_of_total):
-	relevant = np.genfromtxt(file, delimiter=separator, skip_header=startline+1)
-	section_average = []
+	relevant = load_profile(file).data[startline:]
 	rel_fractions=np.asarray(relative_fractions)
-	runningtotal=np.zeros(len(list(relevant[0,:])))
-	#layer=0
-	for i in range(len(list(relevant[:,0]))-1):
-		part1=relevant[i,:]*rel_fractions[i,0] #first weight * first item
-		part2=relevant[i+1,:]*rel_fractions[i,1] #second weight * second item
-		average=part1+part2 #element-wise addition - average between first and second
-		contribution=average*fraction_of_total[i] #each section's contribution to total
-		runningtotal=runningtotal+contribution
-		section_average.append([list(average)])
+	fraction_of_total=np.asarray(fraction_of_total)
+	section_average = rel_fractions[:,0][:,None]*relevant[:-1] + rel_fractions[:,1][:,None]*relevant[1:]
+	runningtotal = fraction_of_total @ section_average #each section's contribution to total
 	return list(runningtotal), section_average
 
-def bulk_mass_fraction(file,startline):
-	shellmasses, weight_masses, fraction_of_mass = weights_by_mass(file,startline)
-	M_runningtotal, M_section_average = find_average(file,startline,weight_masses,fraction_of_mass)
-	columns=read_cols(file)[11:-2] #Excludes iron phase and mass
-	bulkmassfraction=dict(zip(columns, 0.01*np.asarray(M_runningtotal[11:-2])))
-	#print('Done importing composition from ExoPlex.')
-	return bulkmassfraction
+@profiling.profiled()
+def bulk_mass_fraction(file,startline=None):
+	# startline: row where the mantle starts; by default, found from the file
+	return load_profile(file).bulk_mass_fraction(startline)
 
-def build(planet,file):
+@profiling.profiled()
+def build(planet,file,startline=None):
     if not('Tp0' in planet.keys()):
         planet['Tp0'] = DEFAULT['Tp0']
-    startline=1000
-    with open(file) as f:
-        for i, line in enumerate(f):
-            if i == 0:
-                pass
-                #minerals=line.split(separator)[11:-2]
-            elif i == 1:
-                planet['Rp']=np.float(line.split(separator)[0])*1000
-                planet['Rpl']=planet['Rp']/Re
-                planet['Tcmb']=get.CMB_T(planet['Rp'],planet['Tp0'])
-                planet['Sa']=4*np.pi*planet['Rp']**2
-                #Mp,Mc,Rp,Rc,d,Vm,Sa,pm,g,Pcmb,Tcmb=get.build(Mpl=Mpl,Rpl=Rpl,Tp0=Tp0)
-            elif i == startline+1:
-                planet['Rc']=np.float(line.split(separator)[1])*1000
-                planet['d']=planet['Rp']-planet['Rc']
-                planet['Vm']=(4./3.)*np.pi*(planet['Rp']**3 - planet['Rc']**3)
-                planet['Pcmb']=np.float(line.split(separator)[3])
-                planet['Mc']=np.float(line.split(separator)[-1])
-            elif i == 3000:
-                planet['Mp']=np.float(line.split(separator)[-1])
-                planet['pm']=(planet['Mp']-planet['Mc'])/planet['Vm']
-                planet['g']=Grav*planet['Mp']/(planet['Rp']**2)
-                planet['CMF']=planet['Mc']/planet['Mp']
-                planet['CRF']=planet['Rc']/planet['Rp']
+    profile = load_profile(file)
+    planet = profile.structure(planet)
     planet=thermals_from_file(planet, file, startline)
     print('Done importing ExoPlex output file.')
     return planet
 
-def thermals_from_file(planet, file, startline):
-	shellmasses, weight_masses, fraction_of_mass = weights_by_mass(file,startline)
-	M_runningtotal, M_section_average = find_average(file,startline,weight_masses,fraction_of_mass)
-	
-	radii, vol_weights, fraction_of_volume = weights_by_volume(file,startline)
-	V_runningtotal, V_section_average = find_average(file,startline,vol_weights,fraction_of_volume)
-
-	#Get thermal conductivity from uppermost mantle
-	UMradii, UMvol_weights, UMfraction_of_volume = weights_by_volume(file, 2900)
-	UMV_runningtotal, UMV_section_average = find_average(file,2900,UMvol_weights,UMfraction_of_volume)
-	planet['k'] = 0.0681*np.exp(0.0006 * UMV_runningtotal[8] * 1000.0) 
+@profiling.profiled()
+def thermals_from_file(planet, file, startline=None):
+	planet = load_profile(file).thermals(planet, startline)
 	# planet['k'] = get.average_property(get.adds_up(bulk_mass_fraction(file, startline)), 'k', 5.0)
-	planet['alpha'] = V_runningtotal[5]
-	planet['Cp'] = M_runningtotal[6]
 	#lith = get.adds_up(bulk_mass_fraction(file, 2900)) #lithosphere composition - last few lines of exoplex file
 	# This is where viscosity params could be added, from lith proportions
 	print('Done importing thermal parameters from ExoPlex.')
 	return planet
 
-def lith_rheology(file, startline):
-	shellmasses, weight_masses, fraction_of_mass = weights_by_mass(file,startline)
-	M_runningtotal, M_section_average = find_average(file,startline,weight_masses,fraction_of_mass)
-	columns=read_cols(file)[11:-2] #Excludes iron phase and mass
-	bulkmassfraction=dict(zip(columns, 0.01*np.asarray(M_runningtotal[11:-2])))
-	#print('Done importing composition from ExoPlex.')
-	return bulkmassfraction
+def lith_rheology(file, startline=None):
+	return load_profile(file).bulk_mass_fraction(startline)
+
+
+STORE_VERSION = 1
+storename = '.exoplex_cache'
+
+def is_exoplex(file):
+    # True if file starts with an ExoPlex header
+    with open(file, 'r') as f:
+        return f.readline().startswith('#Depth')
+
+def profile_summary(profile):
+    # Purpose: the derived quantities build, thermals_from_file, and bulk_mass_fraction produce, for one profile
+    # Outputs: planet dictionary without Tp0-dependent values (Tcmb), and the bulk mantle composition
+    planet = profile.structure({'Tp0': DEFAULT['Tp0']})
+    del planet['Tp0'], planet['Tcmb']
+    planet = profile.thermals(planet)
+    composition = get.adds_up(profile.bulk_mass_fraction())
+    return planet, composition
+
+def _ingest_one(job):
+    # Parses one ExoPlex file in a worker process, and writes its entry to the store
+    file, entry = job
+    profile = ExoPlexProfile(file)
+    planet, composition = profile_summary(profile)
+    keys = sorted(planet)
+    np.savez_compressed(entry + '.tmp.npz', data=profile.data, columns=np.array(profile.columns), cmb=profile.cmb,
+                        keys=np.array(keys), values=np.array([planet[k] for k in keys]),
+                        minerals=np.array(list(composition)), fractions=np.array(list(composition.values())))
+    os.replace(entry + '.tmp.npz', entry)
+    return file
+
+def ingest_directory(folder='.', store=None, workers=None, pattern='*.csv'):
+    # Purpose: imports every ExoPlex file in a folder, parsing only files that are new or have changed
+    # Inputs: folder of ExoPlex CSVs; store: folder for parsed profiles (default: .exoplex_cache inside folder);
+    #   workers: processes used to parse changed files (default: one per core); pattern: which files to consider
+    # Outputs: dictionary of planet dictionaries, keyed by file name without extension, holding Rp, Rc, Mc, Mp,
+    #   Pcmb, alpha, Cp, k and the other derived structure, plus 'composition' and 'file'
+    # Limitations: entries are keyed by absolute path, size, and modification time. Raw columns are kept in the
+    #   store too; use cached_profile to get them back without re-reading the CSV.
+    # Calls: _ingest_one, load_store
+    store = os.path.join(folder, storename) if store is None else store
+    os.makedirs(store, exist_ok=True)
+    index = read_index(store)
+    files = sorted(os.path.abspath(f) for f in glob.glob(os.path.join(folder, pattern)))
+    files = [f for f in files if f in index['entries'] or is_exoplex(f)]
+    entries = {}
+    jobs = []
+    for file in files:
+        st = os.stat(file)
+        entry = os.path.join(store, hashlib.sha1(file.encode()).hexdigest() + '.npz')
+        entries[file] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'entry': os.path.basename(entry)}
+        old = index['entries'].get(file)
+        if old != entries[file] or not os.path.exists(entry):
+            jobs.append((file, entry))
+    for file in set(index['entries']) - set(entries):  # files that are gone
+        stale = os.path.join(store, index['entries'][file]['entry'])
+        if os.path.exists(stale):
+            os.remove(stale)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2:
+        list(map(_ingest_one, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_ingest_one, jobs))
+    write_index(store, {'version': STORE_VERSION, 'entries': entries})
+    if verbose == "true":
+        print('Parsed', len(jobs), 'of', len(files), 'ExoPlex files.')
+    planets = {}
+    for file in files:
+        planet, composition = load_store_entry(os.path.join(store, entries[file]['entry']))[:2]
+        planet['composition'] = composition
+        planet['file'] = file
+        planets[os.path.splitext(os.path.basename(file))[0]] = planet
+    return planets
+
+def read_index(store):
+    path = os.path.join(store, 'index.json')
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == STORE_VERSION:
+            return index
+    return {'version': STORE_VERSION, 'entries': {}}
+
+def write_index(store, index):
+    path = os.path.join(store, 'index.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
 
+def load_store_entry(entry, profile=False):
+    # Returns: planet dictionary and composition from a store entry, plus the ExoPlexProfile if profile=True
+    with np.load(entry) as npz:
+        planet = dict(zip(npz['keys'].tolist(), npz['values'].tolist()))
+        composition = dict(zip(npz['minerals'].tolist(), npz['fractions'].tolist()))
+        if profile:
+            profile = ExoPlexProfile(None, columns=npz['columns'].tolist(), data=npz['data'])
+    return planet, composition, profile
 
-#thermals = pd.read_csv(file, sep=', header=0, skiprows=startline)
-#note that pandas takes much longer to load the csv for MC cases.
\ No newline at end of file
+def cached_profile(file, store=None):
+    # Purpose: the ExoPlexProfile of file, from the parsed-profile store if its entry is still current
+    file = os.path.abspath(file)
+    store = os.path.join(os.path.dirname(file), storename) if store is None else store
+    old = read_index(store)['entries'].get(file)
+    st = os.stat(file)
+    if old is None or old['size'] != st.st_size or old['mtime'] != st.st_mtime_ns:
+        return load_profile(file)
+    profile = load_store_entry(os.path.join(store, old['entry']), profile=True)[2]
+    profile.file = file
+    return profile
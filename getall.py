@@ -6,15 +6,19 @@ import numpy as np
 from mineralDB import minerals as mins
 Pe = lambda n: format(n, '.4e')
 Pf = lambda n: format(n, '.4f')
-from scipy import stats
+import functools
 import fromexo
+import thermalgrid
+import profiling
 
+@profiling.profiled()
 def setup(planet, ExoPlex, file, startline, my_composition):
 
     if ExoPlex == 'TRUE':
         planet['composition'] = adds_up(fromexo.bulk_mass_fraction(file,startline))
         planet = fromexo.build(planet=planet,file=file)
-        if planet['Pref']<4.001:
+        planet.setdefault('profile', file)
+        if planet['Pref'] != 'depth' and planet['Pref']<4.001:
             planet['Pref'] = 0.5*planet['Pcmb']
         thermals = {'alpha': planet['alpha'], 'Cp': planet['Cp'], 'k': planet['k']} #get.thermals_at_P_ave(composition, Pref)
     else: # custom composition, assumes
@@ -25,7 +29,7 @@ def setup(planet, ExoPlex, file, startline, my_composition):
         composition = planet['composition'] 
         thermals=thermals_at_P_ave(composition,  planet['Pref'])
     if planet['method'] == 'dynamic':
-        thermals=thermals_at_P_ave(planet['composition'], planet['Pref'])
+        thermals=thermals_for(planet)
     planet.update(planet['constants'])
     return planet, thermals
 
@@ -65,7 +69,7 @@ def TWdepVisc(planet):
     #   Ev is populated for some pyroxene phases, but diffusion creep literature is lacking. Dislocation abundant.
     #   Viscosity prefactors required for Arrhenius form (A*exp(Ev/RT)), but numerical studies are normalized to present viscosity.
     #   "Wet" and "dry" diffusion creep activation energies differ. "Dry" values are in minDB.py.
-    # Calls: average_property
+    # Calls: truncnorm
     # Tasks: figure out incorporation of prefactors for Cpx-dominated planets
     #   consider implementation of grain size and/or pressure, to accommodate rheological data whose prefactors depend on this
     #       add wet values to minDB.py and/or use balance of wet/dry to calculate weighted Ev_tot.
@@ -74,14 +78,28 @@ def TWdepVisc(planet):
     # visc0_tot = average_property(composition, 'visc0', visc0_default)
     #gs = 100.0 #grain size in microns - arbitrary right now
     c1 = 0.5
-    Ev = 1000.0 * stats.truncnorm.rvs(-3, 3, loc=364., scale=61., size=500)
+    Ev = 1000.0 * truncnorm(np.random, -3, 3, loc=364., scale=61., size=1)
     #visc0 = 1/(1.00e6 * (10.0**stats.truncnorm.rvs(-2, 2, loc=5.49, scale=0.76, size=1)) * #prefactor
     #         (planet['Water']*1.0e2*1.0e4)**stats.truncnorm.rvs(-2,2,loc=0.85, scale=0.25, size=1) * #wt fraction water to ppm H/Si
     #         gs ** (-1*stats.truncnorm.rvs(-2,2,loc=1.74, scale=0.13))) #grain size
-    flowparams = {'c1': c1, 'Ev': Ev[0], 'visc0': visc0[0]}
+    visc0 = planet.get('visc0', DEFAULT['visc0'])  # until the prefactor above can be drawn, keep the planet's own
+    flowparams = {'c1': c1, 'Ev': Ev[0], 'visc0': visc0}
     planet.update(flowparams)
     return planet
 
+def truncnorm(rng, a, b, loc=0.0, scale=1.0, size=1):
+    # Purpose: draws from a normal distribution truncated to [loc + a*scale, loc + b*scale]
+    # Inputs: random generator (np.random, a RandomState, or a Generator), bounds in standard deviations,
+    #   mean, standard deviation, and number of samples
+    # Outputs: array of samples
+    # Limitations: rejection sampling, so only efficient when [a, b] holds a good share of the distribution
+    x = rng.standard_normal(size)
+    bad = (x < a) | (x > b)
+    while bad.any():
+        x[bad] = rng.standard_normal(int(bad.sum()))
+        bad = (x < a) | (x > b)
+    return loc + scale * x
+
 def viscosity(planet,Tp):
     # Purpose: Arrhenius expression for strictly temperature-dependent viscosity given diffusion creep
     # Inputs: planet dictionary, potential temperature
@@ -230,6 +248,7 @@ def sample_radii(M):
     return
 
 
+@profiling.profiled()
 def build(planet): 
     # Purpose: estimates planet properties given sparse inputs (mass in Me, radius in Re)
     # Inputs: dictionary of fixed planet parameters
@@ -276,6 +295,29 @@ def build(planet):
     return planet
 
 
+def build_arrays(Mpl, Rpl):
+    # Purpose: array version of build, for batches of planets given mass (in Me) and radius (in Re)
+    # Inputs: arrays (or floats) of planet mass and radius
+    # Outputs: dictionary of arrays: Mpl, Rpl (as used), CMF, CRF, Mp, Mc, Rp, Rc, d, Vm, Sa, pm, g, Pcmb
+    # Limitations: as in build, radii are capped at 1.5 Re and masses kept between those for CMF = 0.1 and 0.8,
+    #   but silently; Tcmb is left out, since it depends on each planet's Tp0
+    # Calls: reasonable_mass, CMF_estimate, CRF_estimate, CMB_P
+    # Refs: DOI: 10.1029/2018JE005844, with conclusions drawn from (e.g.) DOI: 10.1088/0004-637X/801/1/41
+    Rpl = np.minimum(np.asarray(Rpl, dtype=float), 1.50)
+    Mpl = np.clip(np.asarray(Mpl, dtype=float), reasonable_mass(Rpl,0.1), reasonable_mass(Rpl,0.8))
+    p = {'Mpl': Mpl, 'Rpl': Rpl}
+    p['CMF'] = CMF_estimate(Mpl,Rpl)
+    p['CRF'] = CRF_estimate(Mpl,p['CMF'],Rpl)
+    p = SIunits(p)
+    p['d'] = p['Rp']-p['Rc']
+    p['Vm'] = (4./3.) * np.pi * ((p['Rp'] ** 3)-(p['Rc'] ** 3))
+    p['Sa'] = 4 * np.pi * (p['Rp'] ** 2)
+    p['pm'] = (p['Mp']-p['Mc'])/p['Vm']
+    p['g'] = Grav * p['Mp']/(p['Rp'] ** 2)
+    p['Pcmb'] = CMB_P(p['Rp'])
+    return p
+
+
 def SIunits(planet): #Mpl,CMF,Rpl,CRF):
     # Converts from Earth-equivalents to SI units
     planet['Mp'] = planet['Mpl'] * Me       # planet mass in kg
@@ -302,62 +344,199 @@ def sample_planets(Rpl,Tp0):
     return
 
 
+@profiling.profiled()
 def thermals_at_P_ave(composition,P):
     # Returns an array, whose columns are: T_P, alpha_P, Cp_P, and k_P
     # i.e., a temperature range, with corresponding compositionally-averaged
     # alpha, Cp, and k for a (predetermined) "average" mantle pressure.
     # Note that this smears out the thermal consequences of pressure-dependent
     # compositional heterogeneity (i.e. it treats mantle as isobaric).
+    # Mixed tables are kept in a bounded LRU cache, keyed on the rounded composition,
+    # the pressure, and the checksum of the mineral grid (see thermals_cache_info).
+    key = composition_key(composition)
+    return np.array(_cached_thermals(key, round(float(P), 9), thermalgrid.load().checksum))
+
+def composition_key(composition):
+    # Purpose: canonical, hashable form of a composition: sorted (mineral, weight) pairs,
+    #   weights rounded to 12 decimals, phases with zero weight dropped
+    return tuple(sorted((str(i), round(float(composition[i]), 12)) for i in composition if composition[i] != 0))
+
+@functools.lru_cache(maxsize=thermals_cache_size)
+def _cached_thermals(key, P, checksum):
+    # checksum only keys the cache, so that tables mixed from an older grid are never reused
+    if profiling.active is not None:
+        profiling.active.count('thermals cache misses')
+    thermals = _mix_thermals(dict(key), P)
+    thermals.flags.writeable = False
+    return thermals
 
-    # The below can be changed if indexing scheme changes from 1 Gpa resolution
-
-    gridstandard = 'alphagrid/O_alphagrid.csv'  # will not be changed when composition method is converted to end-member structure
-
-    lP_index = int(np.floor(P))
-    uP_index = lP_index + 2  # Only two values print due to string read-in mode, one GPa apart.
-    T_P = np.genfromtxt(gridstandard,delimiter=',', usecols=0, skip_header=1)
-    nTs = len(T_P[:])
-    thermals = np.zeros((nTs,4))
-    thermals[:,0] = T_P
-    thermals[:,3] = average_property(composition, 'k', DEFAULT['k'])
-    for i in range(len(thermals[:,3])):
-        krad = (8.5*thermals[i,0]**3)/(1.0e11) # radiative portion from 10.1126/science.283.5408.1699
-        thermals[i,3] = thermals[i,3] + krad
-    fgridstandard = open(gridstandard,'r')
-    Ps = fgridstandard.readline().split(',')[lP_index:uP_index]
-    loP,hiP = np.float(Ps[0]),np.float(Ps[1])
-    hi_wt = (P-loP)/(hiP-loP)
-    lo_wt = (hiP-P)/(hiP-loP)
+def thermals_cache_info():
+    # Hits, misses, and current/maximum size of the thermals_at_P_ave cache
+    return _cached_thermals.cache_info()
 
-    for i in composition:
-        istring = str(i)
-        istring = ''.join(char for char in istring if char.isalnum())
-        cpfile = 'CPgrid/' + istring + '_cpgrid.csv'
-        alphafile = 'alphagrid/' + istring + '_alphagrid.csv'
+def clear_thermals_cache():
+    # Invalidation hook: drops every cached table. Called whenever the mineral grid is rebuilt.
+    _cached_thermals.cache_clear()
+
+thermalgrid.on_reload.append(clear_thermals_cache)
+
+def _mix_thermals(composition,P):
+    # One composition, mixed as a batch of one (see mix_thermals)
+    names = list(composition)
+    return mix_thermals(np.array([[composition[i] for i in names]], dtype=float), P, names)[0]
+
+def krad(T):
+    # Radiative part of the thermal conductivity at T (K), from 10.1126/science.283.5408.1699
+    return (8.5*T**3)/(1.0e11)
+
+def property_vector(names, property, defaultval):
+    # Values of property for each mineral in names, looked up as average_property does
+    values = []
+    for name in names:
         try:
-            cp_arr = np.genfromtxt(cpfile, delimiter=',', skip_header=1, usecols=(lP_index,lP_index + 1))
-            alpha_arr = np.genfromtxt(alphafile, delimiter=',', skip_header=1, usecols=(lP_index,lP_index + 1))
-            thermals[:,1] =  thermals[:,1] + (composition[i] * (alpha_arr[:,0] * lo_wt + alpha_arr[:,1] * hi_wt))
-            thermals[:,2] = thermals[:,2] +  (composition[i] * ((cp_arr[:,0] * lo_wt) + (cp_arr[:,1] * hi_wt)))
+            part = mins[name][property]
         except:
-            cp_arr = np.empty_like(T_P)
-            alpha_arr = np.empty_like(T_P)
-            j = 0
-            for Tp in T_P:
-                alpha_arr[j], cp_arr[j] = DEFAULT['alpha'], DEFAULT['Cp']
-                j = j + 1
-
-            thermals[:,1] = thermals[:,1] + composition[i] * alpha_arr
-            thermals[:,2] = thermals[:,2] + composition[i] * cp_arr
+            part = defaultval
+        values.append(defaultval if part is None else part)
+    return np.array(values, dtype=float)
+
+@profiling.profiled()
+def mix_thermals(weights, P, minerals=None, chunk=2048):
+    # Purpose: thermals_at_P_ave for many compositions at once: one table of T, alpha, Cp, and k per planet
+    # Inputs: weights: (planets x minerals) array of weight fractions, or a DataFrame whose columns are
+    #   the minerals (e.g. the composition from fromexo.load_summary); P: pressure in GPa, one for all or one
+    #   per planet; minerals: mineralDB keys of the columns, if weights is an array (default: every mineral
+    #   in mineralDB, in order); chunk: planets mixed at a time, to bound memory
+    # Outputs: (planets x T x 4) array; planet i's table matches thermals_at_P_ave for its composition and P
+    # Limitations: minerals with zero weight in every planet are never read from the grid. Minerals
+    #   without a grid take DEFAULT alpha and Cp, and DEFAULT k if mineralDB has none, as in thermals_at_P_ave.
+    # Calls: thermalgrid.load, ThermalInterpolator.locate, property_vector, krad
+    if hasattr(weights, 'columns'):
+        minerals, weights = list(weights.columns), weights.values
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    minerals = list(mins.keys()) if minerals is None else list(minerals)
+    n = len(weights)
+    P = np.broadcast_to(np.asarray(P, dtype=float), (n,))
+    used = np.flatnonzero(np.any(weights != 0, axis=0))
+    names = [minerals[j] for j in used]
+    weights = weights[:, used]
+    grid = thermalgrid.load()
+    rows = [grid.row(name) for name in names]
+    gridded = [j for j, row in enumerate(rows) if row is not None]
+    other = [j for j, row in enumerate(rows) if row is None]
+
+    thermals = np.empty((n, len(grid.T), 4))
+    thermals[:, :, 0] = grid.T
+    thermals[:, :, 3] = (weights @ property_vector(names, 'k', DEFAULT['k']))[:, None] + krad(grid.T)
+    defaults = weights[:, other].sum(axis=1)   # minerals without a grid: DEFAULT alpha and Cp
+    thermals[:, :, 1] = (defaults * DEFAULT['alpha'])[:, None]
+    thermals[:, :, 2] = (defaults * DEFAULT['Cp'])[:, None]
+    if not gridded or n == 0:
+        return thermals
+
+    lP_index, hi_wt = grid.interpolator(clamp=False).locate(P=P)[2:4]   # past the grid, extrapolate
+    lo_wt = 1 - hi_wt
+    columns = np.unique(np.r_[lP_index, lP_index + 1])   # only the pressure columns some planet needs
+    span = grid.data[:, :, :, columns[0]:columns[-1] + 1]   # a view: nothing is read outside these columns
+    cube = span[[rows[j] for j in gridded]][:, :, :, columns - columns[0]]   # mineral x property x T x column
+    cube = cube.reshape(len(gridded), -1, len(columns))
+    mineral_weights = weights[:, gridded]
+    for column in np.unique(lP_index):   # planets that share a pair of pressure columns: one product per pair
+        planets = np.flatnonzero(lP_index == column)
+        c = np.searchsorted(columns, column)
+        for start in range(0, len(planets), chunk):
+            part = planets[start:start + chunk]
+            lo = mineral_weights[part] @ cube[:, :, c]
+            hi = mineral_weights[part] @ cube[:, :, c + 1]
+            mixed = lo * lo_wt[part, None] + hi * hi_wt[part, None]
+            thermals[part, :, 1:3] += mixed.reshape(len(part), 2, -1).transpose(0, 2, 1)
+    return thermals
 
+def thermals_for_many(planets):
+    # Purpose: thermals_for for a list of planets, mixing each distinct (composition, Pref) once, all in one batch
+    # Outputs: list of tables, one per planet; planets that share a composition and Pref share one (read-only) table
+    # Calls: mix_thermals, thermals_for (for Pref 'depth')
+    tables = [None] * len(planets)
+    groups = {}
+    for i, planet in enumerate(planets):
+        if planet['Pref'] == 'depth':
+            tables[i] = thermals_for(planet)
+        else:
+            key = (composition_key(planet['composition']), round(float(planet['Pref']), 9))
+            groups.setdefault(key, []).append(i)
+    if groups:
+        keys = list(groups)
+        names = sorted(set(name for key, P in keys for name, weight in key))
+        column = {name: j for j, name in enumerate(names)}
+        weights = np.zeros((len(keys), len(names)))
+        for g, (key, P) in enumerate(keys):
+            for name, weight in key:
+                weights[g, column[name]] = weight
+        mixed = mix_thermals(weights, [P for key, P in keys], names)
+        mixed.flags.writeable = False
+        for g, key in enumerate(keys):
+            for i in groups[key]:
+                tables[i] = mixed[g]
+    return tables
+
+@profiling.profiled()
+def thermals_by_depth(profile, start=None):
+    # Returns an array like thermals_at_P_ave's (columns T, alpha, Cp, k), but mixed shell by shell:
+    # every ExoPlex mantle shell contributes its own phase assemblage at its own pressure, weighted
+    # by its mass, so pressure-dependent heterogeneity is kept rather than smeared out at one Pref.
+    # Shells' weights are first summed onto the grid's pressure columns they interpolate between,
+    # then the whole cube is contracted against those weights in one step.
+    # profile: a fromexo.ExoPlexProfile; start: first mantle row (default: the core-mantle boundary).
+    # Shell pressures are located with the grid's ThermalInterpolator; outside the grid they extrapolate
+    # from its edge columns, as in thermals_at_P_ave.
+    grid = thermalgrid.load()
+    start = profile.cmb if start is None else start
+    rows = profile.data[start:]
+    weights, fractions = profile.weights_by_mass(start)[1:]
+    row_weight = np.zeros(len(rows))  # each row's share of the mantle mass, as in ExoPlexProfile.average
+    row_weight[:-1] = row_weight[:-1] + fractions * weights[:, 0]
+    row_weight[1:] = row_weight[1:] + fractions * weights[:, 1]
+    phases = rows[:, [profile.index[m] for m in profile.minerals]]  # wt % of each phase, shell by shell
+    W = row_weight[:, None] * phases
+    W = W / W.sum()
+    P = rows[:, profile.index['Pressure']]
+    lP_index, hi_wt = grid.interpolator(clamp=False).locate(P=P)[2:4]
+    lo_wt = 1 - hi_wt
+
+    gridded = [j for j, m in enumerate(profile.minerals) if grid.row(m) is not None]
+    ungridded = [j for j, m in enumerate(profile.minerals) if grid.row(m) is None]
+    mineral_rows = np.array([grid.row(profile.minerals[j]) for j in gridded], dtype=int)
+    nA = len(grid.minerals) * len(grid.P)
+    column = (mineral_rows[None, :] * len(grid.P) + lP_index[:, None]).ravel()
+    A = (np.bincount(column, (W[:, gridded] * lo_wt[:, None]).ravel(), nA) +
+         np.bincount(column + 1, (W[:, gridded] * hi_wt[:, None]).ravel(), nA))
+    A = A.reshape(len(grid.minerals), len(grid.P))  # weight of each mineral's grid column
+    mixed = np.einsum('mp,mqtp->qt', A, grid.data)
+
+    thermals = np.zeros((len(grid.T),4))
+    thermals[:,0] = grid.T
+    thermals[:,1] = mixed[0] + W[:, ungridded].sum() * DEFAULT['alpha']  # no grid: assume default values
+    thermals[:,2] = mixed[1] + W[:, ungridded].sum() * DEFAULT['Cp']
+    bulk = dict(zip(profile.minerals, W.sum(axis=0)))
+    thermals[:,3] = average_property(bulk, 'k', DEFAULT['k']) + krad(grid.T)
     return thermals
 
+def thermals_for(planet):
+    # Thermals for a planet's 'dynamic' or 'static' run: mixed at planet['Pref'], or, if planet['Pref']
+    # is 'depth', shell by shell from the ExoPlex profile (or file name) in planet['profile'].
+    if planet['Pref'] == 'depth':
+        profile = planet['profile']
+        if isinstance(profile, str):
+            profile = fromexo.load_profile(profile)
+        return thermals_by_depth(profile)
+    return thermals_at_P_ave(planet['composition'],planet['Pref'])
+
 def Tdep_thermals(thermals,Tp):
     if len(thermals) < 4: #if it's just a dictionary of only 3 values...
         ack=thermals
     else:
         gap = thermals[1,0]-thermals[0,0]
-        lT_index = int(np.floor(Tp/gap))-1
+        lT_index = min(max(int(np.floor(Tp/gap))-1, 0), len(thermals)-2)  # past the table's ends, extrapolate
         loT = thermals[lT_index,0]
         hiT = thermals[lT_index + 1,0]
         hi_wt = (Tp-loT)/(hiT-loT)
@@ -369,6 +548,24 @@ def Tdep_thermals(thermals,Tp):
         ack = {'alpha': alpha, 'Cp': Cp, 'k': k}
     return ack #alpha,Cp,k
 
+def Tdep_thermals_batch(thermals,Tp):
+    # Purpose: array version of Tdep_thermals, for evolving many planets at once
+    # Inputs: thermals array, either one (nT x 4) table shared by all planets or a stack of
+    #   (n x nT x 4) tables, one per planet, or a thermalgrid.ThermalInterpolator built from them
+    #   (ThermalInterpolator.from_tables; build it once when stepping many times); array of n potential temperatures
+    # Outputs: 3 arrays of length n: alpha, Cp, and k at each planet's Tp
+    # Limitations: as Tdep_thermals, k is read at the lower T node, and values past the table's ends extrapolate
+    #   (from its end intervals, so one runaway planet can't halt the rest)
+    # Calls: ThermalInterpolator.from_tables
+    # Tasks: n/a
+    # Refs: n/a
+    if not isinstance(thermals, thermalgrid.ThermalInterpolator):
+        thermals = thermalgrid.ThermalInterpolator.from_tables(thermals)
+    Tp = np.asarray(Tp, dtype=float)
+    table = None if thermals.values.ndim == 3 else np.arange(len(Tp))
+    alpha, Cp, k = thermals(Tp, table=table)[:3]
+    return alpha, Cp, k
+
 def representative_mantle(Rp,Rc):
     # for calculating mantle's volume-averaged properties
     nR = 100
@@ -0,0 +1,116 @@
+# A module for recording thermal evolution histories.
+# Columns are preallocated from tmax/dt and filled in place, so a run never copies its
+# history while it grows; the DataFrame is built once, when the run is done.
+import numpy as np
+import pandas as pd
+from constants import *
+
+def timesteps(tmax, dt):
+    # Purpose: lists the times a fixed-step run visits, accumulating t exactly as the ThermEv loop does
+    # Inputs: 2 floats: end time and step, in Gyr
+    # Outputs: list of floats
+    times = []
+    t = 0.0
+    while t <= tmax:
+        times.append(t)
+        t = t + dt
+    return times
+
+# Output columns of frame(), computed from the raw recorded columns (arrays of any shape)
+outputs = {'time': lambda raw: raw['time'],
+           'temp': lambda raw: raw['temp'],
+           'Ra': lambda raw: np.log10(raw['Ra']),
+           'H': lambda raw: raw['H']/(1.0e12),
+           'Q': lambda raw: raw['Q']/(1.0e12),
+           'Urey': lambda raw: raw['H']/raw['Q'],
+           'viscT': lambda raw: raw['viscT'],
+           'visc0': lambda raw: np.log10(raw['visc0']),
+           'Ev': lambda raw: raw['Ev']/1000.0,
+           'log10visc': lambda raw: np.log10(raw['viscT']),
+           'beta': lambda raw: raw['beta']}
+
+class History:
+    # Purpose: preallocated, columnar recorder for one planet or a batch of planets evolving in lockstep
+    # Inputs: tmax and dt of the run; every: keep every nth step (the final step is always kept);
+    #   ID: run-level identifier, one per planet for batches; n: number of planets recorded together
+    # Outputs: DataFrame from frame(), with ID stored once per planet as a categorical column
+    # Limitations: raw quantities are stored, and derived columns (log10 Ra, Urey, ...) are computed in frame(),
+    #   or one at a time in wide() and final()
+    columns = ['time', 'temp', 'Ra', 'H', 'Q', 'viscT', 'visc0', 'Ev', 'beta']
+
+    def __init__(self, tmax, dt, every=1, ID=None, n=1):
+        self.times = timesteps(tmax, dt)
+        self.keep = np.zeros(len(self.times), dtype=bool)
+        self.keep[::every] = True
+        self.keep[-1] = True
+        self.n = n
+        self.ID = ID
+        self.data = np.empty((int(self.keep.sum()), len(self.columns), n))
+        self.nrows = np.full(n, -1)   # rows kept per planet; -1 while a planet is still running
+        self.step = 0
+        self.rows = 0
+
+    def record(self, t, Tp, Ra, production, loss, viscT, visc0, Ev, beta):
+        if self.keep[self.step]:
+            if np.ndim(Tp) == 0:   # one planet, as plain numbers: a single row write
+                self.data[self.rows, :, 0] = (t, Tp, Ra, production, loss, viscT, visc0, Ev, beta)
+            else:
+                row = self.data[self.rows]
+                for i, value in enumerate((t, Tp, Ra, production, loss, viscT, visc0, Ev, beta)):
+                    row[i] = value
+            self.rows = self.rows + 1
+        self.step = self.step + 1
+
+    def record_steps(self, steps, visc0, Ev, beta):
+        # Records a block of consecutive steps of one planet at once: rows of t, Tp, Ra, production, loss, viscT
+        steps = np.asarray(steps)
+        rows = steps[self.keep[self.step:self.step + len(steps)]]
+        block = self.data[self.rows:self.rows + len(rows), :, 0]
+        block[:, :6] = rows
+        block[:, 6], block[:, 7], block[:, 8] = visc0, Ev, beta
+        self.rows = self.rows + len(rows)
+        self.step = self.step + len(steps)
+
+    def stop(self, mask=True):
+        # Ends the record of the masked planets (e.g. once their Tp goes negative)
+        self.nrows[np.asarray(mask) & (self.nrows < 0)] = self.rows
+
+    def frame(self, outcols=outcols):
+        nrows = self.kept()
+        keep = (np.arange(self.rows)[:, None] < nrows[None, :]).T.ravel()  # planet by planet
+        raw = {c: self.data[:self.rows, i, :].T.ravel()[keep] for i, c in enumerate(self.columns)}
+        IDs = np.arange(self.n) if self.ID is None else np.atleast_1d(np.asarray(self.ID, dtype=object))
+        with np.errstate(all='ignore'):
+            columns = {c: output(raw) for c, output in outputs.items()}
+        columns['ID'] = pd.Categorical(np.repeat(IDs, nrows))
+        return pd.DataFrame(columns, columns=outcols)
+
+    def kept(self):
+        # Rows kept per planet
+        return np.where(self.nrows < 0, self.rows, self.nrows)
+
+    def recorded_times(self):
+        # The time of every kept row (the same for every planet)
+        return self.data[:self.rows, 0, 0].copy()
+
+    def wide(self, column):
+        # Purpose: one output column of frame() as a (kept rows x planets) array, without building the DataFrame
+        # Outputs: NaN after the row where a planet's record stopped
+        raw = {c: self.data[:self.rows, i, :] for i, c in enumerate(self.columns)}
+        with np.errstate(all='ignore'):
+            values = np.array(outputs[column](raw), dtype=float)   # a copy, even for raw columns
+        values[np.arange(self.rows)[:, None] >= self.kept()[None, :]] = np.nan
+        return values
+
+    def final(self, column):
+        # Purpose: each planet's last value of an output column, skipping NaNs as DataFrame.groupby().last() does
+        # Outputs: array with one value per planet (NaN if it has none)
+        values = self.wide(column)
+        valid = ~np.isnan(values)
+        last = self.rows - 1 - np.argmax(valid[::-1], axis=0)
+        found = values[last, np.arange(self.n)] if self.rows > 0 else np.full(self.n, np.nan)
+        return np.where(valid.any(axis=0), found, np.nan)
+
+    def per_planet(self, values):
+        # Repeats one value per planet down that planet's rows of frame()
+        return np.repeat(np.asarray(values), self.kept())
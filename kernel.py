@@ -0,0 +1,114 @@
+# A module for the compiled ThermEv time loop.
+# The Euler loop of evolve.ThermEv is written out here on plain floats and arrays, so Numba can
+# compile it to machine code. Without Numba the same function runs as ordinary Python, which is
+# still faster than the dictionary-based loop, and gives the same results.
+# Recommended use:
+#   Evolution = evolve.ThermEv(planet, thermals, method, Tp0, tmax, jit=True)
+#   kernel.verify(planet, thermals, method, Tp0, tmax)   # max relative difference from the usual loop
+import math
+import numpy as np
+from constants import *
+try:
+    import numba
+except ImportError:  # optional: the kernel then runs uncompiled
+    numba = None
+
+Ts = 273.0  # as in evolve.py, for the Rayleigh number and Frank-Kamenetskii parameter
+
+def jit(function):
+    # Compiles function with Numba when it is installed (cached in __pycache__), else leaves it as is
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+@jit
+def euler(times, Tp0, table, alpha, Cp, k, Mm, pm, g, d, Sa, Ts_surface, Ev, visc0, scaletemp,
+          beta, c1, Qp, decay, Q0, radio):
+    # Purpose: fixed-step Euler integration of one planet's potential temperature, as in ThermEv
+    # Inputs: times (output of history.timesteps); Tp0; table: (nT x 4) T-dependent thermals, or an empty
+    #   (0 x 4) array to keep alpha, Cp, and k constant; columns with a NaN in table[0] are also kept at
+    #   alpha, Cp, k (e.g. planet['constants']); the planet's parameters as floats, with Mm = Mp - Mc;
+    #   decay or Q0 NaN select the 4-isotope heat production or the naive heat flux; radio (evolve.radio)
+    # Outputs: (steps x 6) array of t, Tp, Ra, production, loss, viscT; number of steps taken
+    #   (fewer than len(times) if Tp went negative); and Tp after the last step
+    # Limitations: plain floats and arrays only, so it compiles in Numba's nopython mode
+    out = np.empty((len(times), 6))
+    nT = table.shape[0]
+    visc_offset = Ev/(R*scaletemp) if visc0 >= 1.0e13 else 0.0
+    Tp = Tp0
+    for step in range(len(times)):
+        t = times[step]
+        if Tp < 0:
+            return out, step, Tp
+        if nT > 1:
+            gap = table[1, 0] - table[0, 0]
+            i = min(max(int(math.floor(Tp/gap))-1, 0), nT-2)
+            loT = table[i, 0]
+            hiT = table[i + 1, 0]
+            hi_wt = (Tp-loT)/(hiT-loT)
+            lo_wt = (hiT-Tp)/(hiT-loT)
+            if not math.isnan(table[0, 1]):
+                alpha = table[i, 1] * lo_wt + table[i + 1, 1] * hi_wt
+            if not math.isnan(table[0, 2]):
+                Cp = table[i, 2] * lo_wt + table[i + 1, 2] * hi_wt
+            if not math.isnan(table[0, 3]):
+                k = table[i, 3]
+        viscT = visc0 * math.exp((Ev/(R * Tp)) - visc_offset)
+        Ra = (pm ** 2) * g * alpha * (Tp-Ts) * (d ** 3) * Cp/(k * viscT)
+        if math.isnan(decay):
+            Ht = 0.0
+            for j in range(4):
+                Ht = Ht + radio[0, j] * radio[1, j] * math.exp(radio[2, j] * (-1*t))
+            production = Qp * Ht
+        else:
+            production = Qp * math.exp(-1*decay*t)
+        if math.isnan(Q0):
+            theta = Ev*(Tp-Ts)/(R*(Tp**2))
+            loss = Sa*(c1*k*(Tp-Ts_surface)/d*(theta**(-(1+beta)))*(Ra**(beta)))
+        else:
+            visc_scale = visc0 * math.exp((Ev/(R * scaletemp)) - visc_offset)
+            loss = Q0 * (Tp / scaletemp)**(1 + beta) * (visc_scale / viscT)**(beta)
+        out[step, 0] = t
+        out[step, 1] = Tp
+        out[step, 2] = Ra
+        out[step, 3] = production
+        out[step, 4] = loss
+        out[step, 5] = viscT
+        Tp = Tp + (dt*seconds*(production-loss))/(Cp*Mm)
+    return out, len(times), Tp
+
+def arguments(context):
+    # Purpose: unpacks a run's evolve.RunContext into euler's arguments
+    # Outputs: tuple of euler's arguments after times and Tp0
+    # Calls: evolve.radio
+    import evolve
+    if context.table is not None:
+        table = np.array(context.table, dtype=float)
+        for column, prop in ((1, 'alpha'), (2, 'Cp'), (3, 'k')):
+            if prop in context.fixed:
+                table[:, column] = np.nan   # held at the planet's value, as planet['constants'] asks
+    else:
+        table = np.empty((0, 4))
+    c = context
+    return (table, c.alpha, c.Cp, c.k, c.Mm, c.pm, c.g, c.d, c.Sa, c.Ts, c.Ev, c.visc0, c.scaletemp, c.beta, c.c1,
+            c.Qp, np.nan if c.decay is None else c.decay, np.nan if c.Q0 is None else c.Q0, evolve.radio)
+
+def verify(planet, thermals, method, Tp0, tmax, columns=('temp', 'Ra', 'H', 'Q', 'viscT', 'beta')):
+    # Purpose: compares the kernel against the usual ThermEv loop for one planet
+    # Inputs: as for evolve.ThermEv (the planet is copied for each run)
+    # Outputs: largest relative difference over the given output columns
+    # Calls: evolve.ThermEv
+    import evolve
+    usual = evolve.ThermEv(dict(planet), thermals, method, Tp0, tmax, cache=False)
+    compiled = evolve.ThermEv(dict(planet), thermals, method, Tp0, tmax, jit=True, cache=False)
+    if len(usual) != len(compiled):
+        return np.inf
+    difference = 0.0
+    for column in columns:
+        a, b = usual[column].values, compiled[column].values
+        with np.errstate(all='ignore'):
+            difference = max(difference, float(np.nanmax(np.abs(a-b)/np.maximum(np.abs(a), 1.0e-300))))
+    if verbose == "true":
+        print('Kernel', 'compiled with Numba' if numba is not None else 'uncompiled (Numba not installed)',
+              '- max relative difference:', difference)
+    return difference
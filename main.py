@@ -1,7 +1,6 @@
 # Import external packages
 import numpy as np
 import pandas as pd
-import plotly.io as pio
 
 # Import internal packages
 import evolve
@@ -9,7 +8,6 @@ import fromexo
 import getall as get
 from mineralDB import minerals
 from constants import *
-import plot
 Pe = lambda n: format(n, '.4e')
 Pf = lambda n: format(n, '.4f')
 
@@ -24,7 +22,11 @@ ExoPlex='TRUE'
 
 # Where should I send outputs from this run?
 outfolder = 'OUTPUT/'
-outfile = 'earth_nomantleFe.csv'
+outfile = 'earth_nomantleFe.csv'   # or e.g. 'earth_nomantleFe.parquet', for output.read
+
+# Should I plot this run? If not (e.g. batch runs on a server), the plotting packages are never imported.
+makeplot='TRUE'     # writes the plot to outfolder as HTML
+showplot='TRUE'     # also opens it; set to 'FALSE' when there is no browser or display
 
 # What exoplex file should I import, and where does the mantle start?
 file='earth_nomantleFe_FeMg0.9_0.07_0.9_0.09_0.9.csv'
@@ -70,10 +72,20 @@ if method=='dynamic':
 
 # Evolve your planet over time.
 Evolution = evolve.ThermEv(planet, thermals, method, planet['Tp0'], tmax)
-Evolution.to_csv(outfolder+planet['ID']+outfile)
-p = plot.evolution_colorcoded(Evolution, 'Ra', 'continuous')
-pio.write_html(p, outfolder+planet['ID']+'.html')
-print('Done! See '+outfolder+planet['ID']+'.html for plot.')
+if outfile.endswith('.parquet'):   # compressed and columnar, with the planet's parameters; needs pyarrow
+    import output
+    with output.Writer(outfolder+planet['ID']+outfile, metadata={'method': method, 'tmax': tmax}) as results:
+        results.write(Evolution, planet)
+else:
+    Evolution.to_csv(outfolder+planet['ID']+outfile)
+if makeplot == 'TRUE':
+    import plotly.io as pio
+    import plot
+    p = plot.evolution_colorcoded(Evolution, 'Ra', 'continuous', show=(showplot == 'TRUE'))
+    pio.write_html(p, outfolder+planet['ID']+'.html')
+    print('Done! See '+outfolder+planet['ID']+'.html for plot.')
+else:
+    print('Done! See '+outfolder+planet['ID']+outfile+' for the evolution.')
 
 
 exit()
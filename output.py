@@ -0,0 +1,193 @@
+# A module for writing evolutions to compressed, columnar files, and reading them back selectively.
+# Results go to a folder of Parquet files ("parts"): each part holds whole runs in its row groups (one run
+# per group, or as many as fill rows_per_group, since tiny groups are slow to read), and carries the
+# parameters of its runs, and of the whole output, as JSON in its footer. Runs are buffered and written a
+# part at a time, so a sweep can stream results to disk as they come in; reopening the folder later appends
+# new parts. Readers load only the columns and planets asked for, skipping row groups by their ID statistics.
+# Needs pyarrow (an optional extra, listed at the end of requirements.txt; only this module uses it).
+# Recommended use:
+#   with output.Writer('OUTPUT/sweep.parquet', float32=True, metadata={'method': 'dynamic'}) as results:
+#       results.write(Evolution, planet)            # one run, with its planet dictionary
+#       results.write(Evolution, samples)           # or a batch, with one row of parameters per ID
+#   output.read('OUTPUT/sweep.parquet', columns=['time', 'temp'], IDs=['earth'])
+#   output.runs('OUTPUT/sweep.parquet')             # one row of parameters per run
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+from constants import *
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: needed only to write or read Parquet results
+    pa = pq = None
+
+history_columns = ['temp', 'Ra', 'H', 'Q', 'Urey', 'viscT', 'visc0', 'Ev', 'log10visc', 'beta']  # float32 candidates
+
+def require():
+    if pq is None:
+        raise ImportError('Parquet output needs pyarrow: pip install pyarrow')
+
+def jsonable(value):
+    # JSON fallback for NumPy values and anything else a planet dictionary may hold
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+def parts(path):
+    # The part files of an output folder, in the order they were written
+    return sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+
+class Writer:
+    # Purpose: appends evolutions to an output folder of Parquet parts
+    # Inputs: path of the folder (created if needed; existing parts are kept, and new ones follow them);
+    #   float32: store the history columns (history_columns) in single precision, about half the size
+    #   (None: as the existing parts, or False for a new folder);
+    #   compression: Parquet codec, e.g. 'zstd', 'snappy', 'gzip', or None;
+    #   rows_per_part: rows buffered in memory before a part is written; rows_per_group: a row group ends at the
+    #   first run boundary after this many rows (0: one run per row group);
+    #   metadata: dictionary describing the whole output (method, tmax, ...), stored in every part
+    #   (None: as the existing parts, or empty for a new folder)
+    # Outputs: write(Evolution, parameters) buffers the runs of an Evolution DataFrame (one or many IDs);
+    #   flush() writes the buffer out as one part; close() flushes. Also a context manager.
+    # Limitations: a part appears (atomically) only when it's written, so a run is on disk after the next flush.
+    #   Reopening a folder keeps the schema and metadata of its parts: a float32 setting or metadata that
+    #   disagrees with them raises ValueError, as do runs whose columns differ from theirs.
+    def __init__(self, path, float32=None, compression='zstd', rows_per_part=500000, rows_per_group=10000,
+                 metadata=None):
+        require()
+        self.path = path
+        self.compression = compression
+        self.rows_per_part = rows_per_part
+        self.rows_per_group = rows_per_group
+        self.schema = None
+        self.tables = []       # one table per run, waiting for the next flush
+        self.parameters = []   # one dictionary per run, in the same order
+        self.rows = 0
+        os.makedirs(path, exist_ok=True)
+        existing = parts(path)
+        self.part = int(os.path.basename(existing[-1])[5:-8]) + 1 if existing else 0
+        if existing:   # appending: every part must read back alike, so follow the parts already there
+            stored = pq.read_schema(existing[-1])
+            self.schema = stored.remove_metadata()
+            floats = [f.type for f in self.schema if f.name in history_columns and pa.types.is_floating(f.type)]
+            stored_float32 = bool(floats) and all(pa.types.is_float32(t) for t in floats)
+            if float32 is not None and floats and float32 != stored_float32:
+                raise ValueError(path + ' holds ' + ('float32' if stored_float32 else 'float64') +
+                                 ' history columns; open it with float32=' + str(stored_float32) + ' or None.')
+            float32 = stored_float32
+            stored_metadata = json.loads(stored.metadata[b'exoevo.metadata'])
+            if metadata is not None and json.loads(json.dumps(metadata, default=jsonable)) != stored_metadata:
+                raise ValueError('metadata ' + json.dumps(metadata, default=jsonable) + ' differs from that of ' +
+                                 path + ': ' + json.dumps(stored_metadata) + '; open it with metadata=None.')
+            metadata = stored_metadata
+        self.float32 = bool(float32)
+        self.metadata = dict(metadata or {})
+
+    def write(self, Evolution, parameters=None):
+        # Inputs: Evolution DataFrame of one or many runs (rows of a run together, as ThermEv and ThermEvBatch
+        #   write them); parameters: for one run, a dictionary (e.g. the planet); for many, a DataFrame with an
+        #   ID column or ID index (e.g. ensemble samples), or a dictionary of ID -> dictionary
+        frame = Evolution.reset_index(drop=True)
+        if 'ID' in frame:
+            frame['ID'] = frame['ID'].astype(str)
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self.float32:
+            fields = [pa.field(f.name, pa.float32()) if f.name in history_columns and pa.types.is_floating(f.type) else f
+                      for f in table.schema]
+            table = table.cast(pa.schema(fields))
+        if self.schema is None:
+            self.schema = table.schema.remove_metadata()
+        if sorted(table.schema.names) != sorted(self.schema.names):
+            raise ValueError('Columns ' + str(table.schema.names) + ' differ from those of ' + self.path + ': ' +
+                             str(self.schema.names))
+        table = table.select(self.schema.names).cast(self.schema)
+        if 'ID' in frame:
+            IDs = frame['ID'].values
+            starts = np.r_[0, np.flatnonzero(IDs[1:] != IDs[:-1]) + 1]
+        else:
+            IDs, starts = np.array(['']), np.array([0])
+        lookup = by_ID(parameters)
+        for start, stop in zip(starts, np.r_[starts[1:], len(frame)]):
+            ID = IDs[start]
+            run = {'ID': ID, 'rows': int(stop - start)}
+            if lookup is not None:
+                run.update(lookup.get(ID, {}))
+            elif isinstance(parameters, dict):
+                run.update(parameters)
+            self.tables.append(table.slice(start, stop - start))
+            self.parameters.append(run)
+        self.rows = self.rows + len(frame)
+        if self.rows >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        # Writes the buffered runs out as the next part
+        if not self.tables:
+            return None
+        metadata = {'exoevo.runs': json.dumps(self.parameters, default=jsonable),
+                    'exoevo.metadata': json.dumps(self.metadata, default=jsonable)}
+        schema = self.schema.with_metadata(metadata)
+        name = os.path.join(self.path, 'part-' + format(self.part, '05d') + '.parquet')
+        temporary = os.path.join(self.path, '.part-' + format(self.part, '05d') + '.tmp')   # hidden from readers
+        with pq.ParquetWriter(temporary, schema, compression=self.compression) as parquet:
+            group = []
+            for table in self.tables:
+                group.append(table)
+                if sum(len(t) for t in group) >= self.rows_per_group:
+                    parquet.write_table(pa.concat_tables(group))
+                    group = []
+            if group:
+                parquet.write_table(pa.concat_tables(group))
+        os.replace(temporary, name)
+        self.part = self.part + 1
+        self.tables, self.parameters, self.rows = [], [], 0
+        return name
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def by_ID(parameters):
+    # Per-run parameters, as a dictionary of ID (string) -> dictionary; None for a single run's dictionary
+    if parameters is None:
+        return {}
+    if isinstance(parameters, pd.DataFrame):
+        table = parameters if 'ID' in parameters else parameters.rename_axis('ID').reset_index()
+        return {str(row['ID']): row for row in table.to_dict('records')}
+    if isinstance(parameters, dict) and parameters and all(isinstance(v, dict) for v in parameters.values()):
+        return {str(ID): p for ID, p in parameters.items()}
+    return None
+
+def read(path, columns=None, IDs=None):
+    # Purpose: reads (part of) an output folder or part file back into a DataFrame
+    # Inputs: path; columns to load (default: all); IDs: planets to load (default: all)
+    # Outputs: DataFrame with the ID column as strings
+    # Limitations: only the requested columns are read, and row groups without any of the IDs are skipped
+    require()
+    filters = None if IDs is None else [('ID', 'in', [str(ID) for ID in IDs])]
+    return pq.read_table(path, columns=None if columns is None else list(columns), filters=filters).to_pandas()
+
+def runs(path):
+    # Purpose: the parameters of every run in an output folder, read from the part footers only
+    # Outputs: DataFrame with one row per run (ID, rows, and the parameters given to Writer.write)
+    require()
+    rows = []
+    for part in parts(path) if os.path.isdir(path) else [path]:
+        rows.extend(json.loads(pq.read_schema(part).metadata[b'exoevo.runs']))
+    return pd.DataFrame(rows)
+
+def metadata(path):
+    # The metadata dictionary given to Writer, from the last part written (every part of a folder holds the same)
+    require()
+    found = parts(path) if os.path.isdir(path) else [path]
+    return json.loads(pq.read_schema(found[-1]).metadata[b'exoevo.metadata']) if found else {}
@@ -1,15 +1,21 @@
-import matplotlib.pyplot as plt
+# matplotlib.pyplot is imported by the functions that use it, so plotly-only plotting starts faster
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
 
-def pseudo_heat(df, xval, yval, colorcolumn, colortype):
+large = 100000  # rows above which plots switch to WebGL, downsampled runs, and trimmed hover data
+
+def pseudo_heat(df, xval, yval, colorcolumn, colortype, show=True, hover=None, webgl=None):
 	# Input: nparray = Numpy array; columnkeys = list of strings; colorcolumn = col name; colortype = continuous or discrete
-	# df = pd.DataFrame(data=nparray, columns=columnkeys)
+	# df = pd.DataFrame(data=nparray, columns=columnkeys); show = False skips opening the plot
+	# hover: columns shown on hover (default: Ev, visc0, Urey, temp); webgl: force WebGL (default: above `large` rows)
+	if hover is None:
+		hover = ['Ev', 'visc0', 'Urey', 'temp']
+	render_mode = 'webgl' if (len(df) > large if webgl is None else webgl) else 'auto'
 	if colortype == "continuous":
 		plot = px.scatter(df, x=xval, y=yval, opacity = 0.5, color=colorcolumn, template = 'plotly_white+presentation',
-			hover_data=['Ev', 'visc0', 'Urey', 'temp'], color_continuous_scale=px.colors.sequential.Rainbow) #diverging.Spectral[::-1])
+			hover_data=hover, render_mode=render_mode, color_continuous_scale=px.colors.sequential.Rainbow) #diverging.Spectral[::-1])
 		plot.layout.xaxis.title.text=xval
 		plot.layout.yaxis.title.text=yval
 		plot.update_traces(marker=dict(size=30.0))  #, color='rgba(1, 1, 1, 0.5)'))
@@ -27,28 +33,39 @@ def pseudo_heat(df, xval, yval, colorcolumn, colortype):
 	plot.update_yaxes(showline=True, linewidth=2, linecolor='black', mirror=True, range=[ymin, ymax]) #[11, 18]) #
 	plot.update_layout(showlegend=False) 
 	#yaxis_type='log')
-	plot.show()
+	if show:
+		plot.show()
 	return df
 
 
-def evolution_colorcoded(df, colorcolumn, colortype):
+def evolution_colorcoded(df, colorcolumn, colortype, show=True, points=None, hover=None, webgl=None):
 	# Input: nparray = Numpy array; columnkeys = list of strings; colorcolumn = col name; colortype = continuous or discrete
-	# df = pd.DataFrame(data=nparray, columns=columnkeys)
+	# df = pd.DataFrame(data=nparray, columns=columnkeys); show = False returns the figure without opening it
+	# points: keep this many points of each run (see decimate); hover: columns shown on hover; webgl: force WebGL.
+	# Above `large` rows, these default to 200 points per run, ID, colorcolumn and temp on hover, and WebGL.
+	big = len(df) > large
+	if points is None and big:
+		points = 200
+	if points is not None:
+		df = decimate(df, points)
+	if hover is None:
+		hover = [c for c in dict.fromkeys(['ID', colorcolumn, 'temp']) if c in df] if big else list(df.keys())
+	render_mode = 'webgl' if (big if webgl is None else webgl) else 'auto'
 	if colortype == "continuous":
 		plot = px.scatter(df, x="time", y="temp", opacity = 0.05, color=colorcolumn, template = 'plotly_white+presentation',
-			hover_data=list(df.keys()), color_continuous_scale=px.colors.sequential.Bluered) #diverging.Spectral[::-1])
+			hover_data=hover, render_mode=render_mode, color_continuous_scale=px.colors.sequential.Bluered) #diverging.Spectral[::-1])
 		plot.layout.xaxis.title.text='Time, Ga'
 		plot.layout.yaxis.title.text='Temp, K'
 		plot.update_traces(marker=dict(size=5.0, opacity=0.3))  #, color='rgba(1, 1, 1, 0.5)'))
 	if colortype == 'discrete':
 		df[colorcolumn] = df[colorcolumn].astype(str)
 		plot = px.line(df, x="time", y="temp", color=colorcolumn, template = 'plotly_white+presentation',
-			color_discrete_sequence=px.colors.qualitative.Vivid, hover_data=list(df.keys()))
+			color_discrete_sequence=px.colors.qualitative.Vivid, hover_data=hover, render_mode=render_mode)
 		plot.layout.xaxis.title.text='Time, Ga'
 		plot.layout.yaxis.title.text='Temp, K'
 	if colortype == None:
 		plot = px.line(df, x="time", y="temp", template = 'plotly_white+presentation',
-			hover_data=list(df.keys()))
+			hover_data=hover, render_mode=render_mode)
 		plot.update_traces(line=dict(width=3.0, color='rgba(1, 1, 1, 0.1)'))
 		plot.layout.xaxis.title.text='Time, Ga'
 		plot.layout.yaxis.title.text='Temperature, K'
@@ -58,10 +75,100 @@ def evolution_colorcoded(df, colorcolumn, colortype):
 	plot.update_yaxes(showline=True, linewidth=2, linecolor='black', mirror=True, range=[ymin, ymax]) #[11, 18]) #
 	plot.update_layout(showlegend=False) 
 	#yaxis_type='log'
-	plot.show()
+	if show:
+		plot.show()
+	return plot
+
+def lttb(x, y, n):
+	# Purpose: Largest-Triangle-Three-Buckets downsampling: picks n points that keep the shape of a curve
+	# Inputs: x (m increasing values); y: m values, or (runs x m) array of runs that share x; n points to keep
+	# Outputs: indices of the kept points, (n) or (runs x n); the first and last points are always kept
+	# Limitations: areas are measured in the data's own units, as in the original algorithm
+	# Refs: Steinarsson 2013, http://hdl.handle.net/1946/15343
+	x = np.asarray(x, dtype=float)
+	y = np.asarray(y, dtype=float)
+	single = y.ndim == 1
+	y = np.atleast_2d(y)
+	runs, m = y.shape
+	if n >= m or n < 3:
+		keep = np.tile(np.arange(m), (runs, 1))
+		return keep[0] if single else keep
+	edges = np.linspace(1, m - 1, n - 1).astype(int)   # n-2 buckets between the first and last points
+	keep = np.empty((runs, n), dtype=int)
+	keep[:, 0], keep[:, -1] = 0, m - 1
+	rows = np.arange(runs)
+	for b in range(n - 2):
+		lo, hi = edges[b], edges[b + 1]
+		nlo, nhi = (edges[b + 1], edges[b + 2]) if b + 2 < n - 1 else (m - 1, m)
+		ax, ay = x[keep[:, b]], y[rows, keep[:, b]]       # the point kept from the previous bucket
+		cx, cy = x[nlo:nhi].mean(), y[:, nlo:nhi].mean(axis=1)   # the mean of the next bucket
+		area = np.abs((ax - cx)[:, None] * (y[:, lo:hi] - ay[:, None]) - (ax[:, None] - x[lo:hi]) * (cy - ay)[:, None])
+		keep[:, b + 1] = lo + np.argmax(area, axis=1)
+	return keep[0] if single else keep
+
+def decimate(df, points=200, x='time', y='temp', by='ID'):
+	# Purpose: thins every run of an Evolution DataFrame to points rows chosen by lttb, for plotting
+	# Inputs: DataFrame of one or many runs, told apart by the column by; rows per run to keep; the curve (x, y) to keep
+	# Outputs: the kept rows, in their original order
+	# Limitations: runs are assumed to be in time order, as ThermEv and ThermEvBatch write them
+	codes = pd.factorize(df[by])[0] if by in df else np.zeros(len(df), dtype=int)
+	order = np.argsort(codes, kind='stable')
+	starts = np.r_[0, np.flatnonzero(np.diff(codes[order])) + 1]
+	lengths = np.diff(np.r_[starts, len(df)])
+	xs, ys = df[x].values[order].astype(float), df[y].values[order].astype(float)
+	kept = []
+	for length in np.unique(lengths):
+		first = starts[lengths == length]
+		rows = first[:, None] + np.arange(length)
+		if np.all(xs[rows] == xs[rows[0]]):    # runs on the same time grid are thinned together
+			kept.append(np.take_along_axis(rows, lttb(xs[rows[0]], ys[rows], points), axis=1).ravel())
+		else:
+			kept.extend(row[lttb(xs[row], ys[row], points)] for row in rows)
+	return df.iloc[np.sort(order[np.concatenate(kept)])]
+
+def ensemble_bands(df, column='temp', percentiles=(5, 25, 50, 75, 95), density=False, bins=(200, 200), show=True):
+	# Purpose: aggregate view of an ensemble: shaded percentile bands around the median over time,
+	#   optionally over a 2-D histogram of every run, so the figure's size doesn't grow with the number of runs
+	# Inputs: Evolution DataFrame of many runs, or the envelopes from ensemble.run (columns such as temp_p50);
+	#   column to show; percentiles (symmetric pairs become bands, the middle one the line); density: add the
+	#   histogram (needs the Evolution); bins: (time, column) histogram bins; show: open the plot
+	# Outputs: plotly figure
+	# Calls: ensemble.envelopes
+	if column + '_p' + str(percentiles[len(percentiles) // 2]) in df:
+		bands = df
+	else:
+		import ensemble
+		bands = ensemble.envelopes(df, (column,), percentiles)
+	times = bands.index.values
+	plot = go.Figure()
+	if density:
+		counts, tedges, yedges = np.histogram2d(df['time'].values, df[column].values, bins=bins)
+		plot.add_trace(go.Heatmap(x=0.5*(tedges[:-1]+tedges[1:]), y=0.5*(yedges[:-1]+yedges[1:]), z=np.log10(1+counts.T),
+			colorscale='Greys', showscale=False, hoverinfo='skip'))
+	pairs = len(percentiles) // 2
+	for i in range(pairs):
+		low, high = percentiles[i], percentiles[-1 - i]
+		opacity = 0.15 + 0.3 * (i + 1) / pairs
+		plot.add_trace(go.Scatter(x=times, y=bands[column + '_p' + str(low)], mode='lines', line=dict(width=0),
+			showlegend=False, hoverinfo='skip'))
+		plot.add_trace(go.Scatter(x=times, y=bands[column + '_p' + str(high)], mode='lines', line=dict(width=0),
+			fill='tonexty', fillcolor='rgba(140, 29, 64, ' + format(opacity, '.2f') + ')',
+			name=str(low) + '-' + str(high) + '%'))
+	if len(percentiles) % 2:
+		middle = percentiles[pairs]
+		plot.add_trace(go.Scatter(x=times, y=bands[column + '_p' + str(middle)], mode='lines',
+			line=dict(width=3.0, color='black'), name=str(middle) + '%'))
+	plot.update_layout(template='plotly_white+presentation', font=dict(family='Arial'))
+	plot.layout.xaxis.title.text = 'Time, Ga'
+	plot.layout.yaxis.title.text = 'Temperature, K' if column == 'temp' else column
+	plot.update_xaxes(showline=True, ticks="inside", linewidth=2, linecolor='black', mirror=True, range=[times[0], times[-1]])
+	plot.update_yaxes(showline=True, linewidth=2, linecolor='black', mirror=True)
+	if show:
+		plot.show()
 	return plot
 
 def plot_pd_mylimits(df, p):
+	import matplotlib.pyplot as plt
 	#input required: pandas data frame, plus dictionary formatted as follows (example case)
 	# p1 = {'x': 'time', 'y': 'temp', 'showlegend': False, 'title': 'Thermal history sample case', 'xlim': (0.0, 4.55), 'ylim': (800,2000)}
 	a = df.plot(x = p['x'], y = p['y'], title = p['title'], s=0.5, xlim=xlim, ylim=ylim,
@@ -72,6 +179,7 @@ def plot_pd_mylimits(df, p):
 	return None
 
 def plot_pd_autolimit(df, p):
+    import matplotlib.pyplot as plt
     #input required: pandas data frame, plus dictionary formatted as follows (example case)
     # p1 = {'x': 'time', 'y': 'temp', 'showlegend': False, 'title': 'Thermal history sample case'}
     if np.log10(np.max(np.abs(df[p['y']]))) - np.log10(np.min(np.abs(df[p['y']]))) > 3: # if the y limits span >3 orders of magnitude,
@@ -85,6 +193,7 @@ def plot_pd_autolimit(df, p):
 
 
 def plot_boolean(df, p):
+    import matplotlib.pyplot as plt
 	#input required: pandas data frame with a boolean column (here called 'passfail' - will change to slicing, etc. later
 	# ...plus dictionary formatted as follows (example case)
 	# p1 = {'x': 'time', 'y': 'temp', 'showlegend': False, 'title': 'Thermal history sample case', 'colorcolumn': 'passfail'}
@@ -0,0 +1,131 @@
+# A module for opt-in timing and memory instrumentation.
+# Nothing is measured unless a Profiler is active: entry points decorated with profiled() then add their
+# time and calls to it, and evolve.ThermEv(..., profile=...) times each phase of every step.
+# When no Profiler is active, a decorated call costs one extra check.
+# Recommended use:
+#   Evolution, report = evolve.ThermEv(planet, thermals, method, Tp0, tmax, profile=True)
+#   report['phases']                   # seconds, calls, and share of the run per phase
+#   with profiling.Profiler(memory=True) as prof:   # any code, e.g. a whole sweep
+#       ...
+#   prof.report()
+import time
+import functools
+import tracemalloc
+import pandas as pd
+
+active = None  # the Profiler currently collecting, if any
+
+def profiled(name=None):
+    # Decorator: times each call of an entry point, under name (default: module.function), while a Profiler is active
+    def wrap(function):
+        label = name or function.__module__ + '.' + function.__name__
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            profiler = active
+            if profiler is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.add(label, time.perf_counter() - start)
+        return timed
+    return wrap
+
+class Profiler:
+    # Purpose: collects per-phase timers, call counters, and (optionally) allocation statistics
+    # Inputs: memory: also trace allocations with tracemalloc (several times slower while active);
+    #   step: function called after every ThermEv step as step(t, Tp, viscT, Ra, production, loss)
+    # Outputs: report(): dictionary with 'phases' (DataFrame of seconds, calls, seconds per call, and share
+    #   of the wall time, per phase), 'counters', 'wall' (seconds active), and 'memory' (peak and net MB,
+    #   and the top allocating lines) if memory=True
+    # Limitations: phase times are inclusive, so an entry point called by another is counted in both
+    def __init__(self, memory=False, step=None):
+        self.memory = memory
+        self.step = step
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.wall = 0.0
+        self.allocations = None
+        self._outer = None
+        self._started = None
+
+    def add(self, phase, seconds, calls=1):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + calls
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def timed(self, phase, function):
+        # function, wrapped so every call adds to phase
+        perf_counter = time.perf_counter
+        def timed(*args):
+            start = perf_counter()
+            result = function(*args)
+            self.add(phase, perf_counter() - start)
+            return result
+        return timed
+
+    def state(self, context):
+        # evolve.RunContext.state, timed phase by phase
+        perf_counter = time.perf_counter
+        add = self.add
+        def state(t, Tp):
+            t0 = perf_counter()
+            alpha, Cp, k = context.properties(Tp)
+            t1 = perf_counter()
+            viscT = context.viscosity(Tp)
+            t2 = perf_counter()
+            Ra = context.rayleigh(Tp, alpha, Cp, k, viscT)
+            t3 = perf_counter()
+            production = context.production(t)
+            t4 = perf_counter()
+            loss = context.loss(Tp, k, Ra, viscT)
+            t5 = perf_counter()
+            add('thermals', t1 - t0)
+            add('viscosity', t2 - t1)
+            add('rayleigh', t3 - t2)
+            add('production', t4 - t3)
+            add('loss', t5 - t4)
+            return viscT, Ra, production, loss, Cp
+        return state
+
+    def __enter__(self):
+        global active
+        self._outer = active
+        active = self
+        if self.memory:
+            self._tracing = tracemalloc.is_tracing()
+            if not self._tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self._before = tracemalloc.take_snapshot()
+            self._current = tracemalloc.get_traced_memory()[0]
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        self.wall = self.wall + time.perf_counter() - self._started
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().compare_to(self._before, 'lineno')[:10]
+            self.allocations = {'peak_MB': (peak - self._current) / 1.0e6, 'net_MB': (current - self._current) / 1.0e6,
+                                'top': [str(stat) for stat in top]}
+            if not self._tracing:
+                tracemalloc.stop()
+        active = self._outer
+        return False
+
+    def report(self):
+        phases = pd.DataFrame({'seconds': pd.Series(self.seconds, dtype=float),
+                               'calls': pd.Series(self.calls, dtype=int)})
+        phases['per_call'] = phases['seconds'] / phases['calls']
+        phases['share'] = phases['seconds'] / self.wall if self.wall > 0 else float('nan')
+        report = {'phases': phases.sort_values('seconds', ascending=False), 'counters': dict(self.counters),
+                  'wall': self.wall}
+        if self.allocations is not None:
+            report['memory'] = self.allocations
+        return report
@@ -0,0 +1,103 @@
+# A module for radially resolved (1-D) mantle thermal evolution.
+# The mantle of an ExoPlex profile is cut into spherical shells between the core-mantle boundary and
+# the surface. Each step balances every shell's heat content against radiogenic heating, exchange with
+# its neighbours, and (for the top shell) loss through the lid. Exchange is implicit (backward Euler), so
+# each step is one tridiagonal solve. Temperatures are potential temperatures; the actual temperature of
+# a shell follows the ExoPlex adiabat.
+# Recommended use:
+#   import radial, fromexo
+#   profile = fromexo.load_profile(file)
+#   Evolution, Profiles = radial.ThermEvRadial(planet, thermals, method, planet['Tp0'], tmax, profile)
+import numpy as np
+import pandas as pd
+from scipy.linalg import solve_banded
+import evolve
+from history import History
+from constants import *
+
+def shells(profile, nshells=50):
+    # Purpose: coarsens an ExoPlex profile's mantle into nshells shells of equal thickness
+    # Inputs: fromexo.ExoPlexProfile; number of shells
+    # Outputs: dictionary of arrays: edges (nshells+1 radii, m), radius (shell centers, m), mass (kg),
+    #   pressure (GPa), and adiabat (actual over potential temperature, 1 at the surface)
+    # Limitations: masses come from ExoPlex's cumulative mass column; other columns are read at shell centers
+    R = profile.column('Radius', profile.cmb) * 1000
+    edges = np.linspace(R[0], R[-1], nshells + 1)
+    radius = 0.5 * (edges[:-1] + edges[1:])
+    T = profile.column('Temperature', profile.cmb)
+    return {'edges': edges,
+            'radius': radius,
+            'mass': np.diff(np.interp(edges, R, profile.column('Mass', profile.cmb))),
+            'pressure': np.interp(radius, R, profile.column('Pressure', profile.cmb)),
+            'adiabat': np.interp(radius, R, T) / T[-1]}
+
+def exchange(geometry):
+    # Purpose: conductance between neighbouring shells per unit conductivity: area / distance, in m
+    # Outputs: (3 x nshells) band of the matrix that, times an effective conductivity, moves heat between shells
+    #   (upper, main, and lower diagonals, in scipy.linalg.solve_banded's layout)
+    area = 4 * np.pi * geometry['edges'][1:-1] ** 2
+    G = area / np.diff(geometry['radius'])
+    band = np.zeros((3, len(geometry['radius'])))
+    band[0, 1:] = -G
+    band[2, :-1] = -G
+    band[1, :-1] += G
+    band[1, 1:] += G
+    return band
+
+def ThermEvRadial(planet, thermals, method, Tp0, tmax, profile, nshells=50, every=1):
+    # Purpose: thermal evolution of a planet's mantle resolved into radial shells
+    # Inputs: as evolve.ThermEv, plus the planet's fromexo.ExoPlexProfile (or a file name) and the number of shells
+    # Outputs: Evolution DataFrame as from ThermEv, with temp the mass-weighted mean potential temperature,
+    #   and Ra, viscT, and heat loss from the top shell's; and Profiles DataFrame (ID, time, radius and depth
+    #   in km, pressure in GPa, potential temperature temp and actual temperature T) for the same steps
+    # Limitations: heat loss through the lid follows ThermEv's scaling law, at the top shell's temperature. Inside
+    #   the mantle, convection is represented by an effective conductivity k * Nu^2 - i.e. the k * Nu that carries
+    #   the surface flux across the whole mantle, concentrated into a boundary layer d/Nu thick - so the interior
+    #   stays near the adiabat. No heat flows from the core, as in ThermEv. With nshells=1 it matches ThermEv.
+    # Calls: evolve.prepare, evolve.RunContext, shells, exchange, scipy.linalg.solve_banded
+    # Refs: boundary layer theory as in DOI: 10.1017/CBO9780511612879
+    if isinstance(profile, str):
+        import fromexo
+        profile = fromexo.load_profile(profile)
+    Hts = History(tmax, dt, every=every, ID=planet['ID'])
+    thermals = evolve.prepare(planet, thermals, method)
+    context = evolve.RunContext(planet, thermals, method)
+    planet.update(planet['constants'])
+
+    geometry = shells(profile, nshells)
+    fraction = geometry['mass'] / geometry['mass'].sum()
+    mass = fraction * context.Mm          # so the mantle holds as much heat as in ThermEv
+    band = exchange(geometry)
+    step = dt * seconds
+    temps = np.empty((len(Hts.data), nshells))
+    theta = np.full(nshells, float(Tp0))
+    Tp = float(Tp0)
+    for t in Hts.times:
+        if Tp < 0 or theta[-1] < 0:
+            evolve.broke(planet, t)
+            break
+        viscT, Ra, production, loss, Cp = context.state(t, theta[-1])
+        Nu = loss * context.d / (context.Sa * context.k * (theta[-1] - context.Ts))
+        capacity = mass * Cp / step
+        ab = band * (context.k * Nu * Nu)
+        ab[1] += capacity
+        rhs = capacity * theta + production * fraction
+        rhs[-1] -= loss
+        if Hts.keep[Hts.step]:
+            temps[Hts.rows] = theta
+        Hts.record(t, Tp, Ra, production, loss, viscT, context.visc0, context.Ev, context.beta)
+        theta = solve_banded((1, 1), ab, rhs, overwrite_ab=True, check_finite=False)
+        Tp = float(fraction @ theta)
+
+    Evolution = Hts.frame(planet['outcols'])
+    Evolution['passfail'] = (np.abs(Tp-1625.0)<50)
+    temps = temps[:Hts.rows]
+    depth = (geometry['edges'][-1] - geometry['radius']) / 1000
+    Profiles = pd.DataFrame({'ID': pd.Categorical(np.repeat([planet['ID']], temps.size)),
+                             'time': np.repeat(Hts.data[:Hts.rows, 0, 0], nshells),
+                             'radius': np.tile(geometry['radius'] / 1000, Hts.rows),
+                             'depth': np.tile(depth, Hts.rows),
+                             'pressure': np.tile(geometry['pressure'], Hts.rows),
+                             'temp': temps.ravel(),
+                             'T': (temps * geometry['adiabat']).ravel()})
+    return Evolution, Profiles
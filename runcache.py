@@ -0,0 +1,174 @@
+# A module for keeping finished evolutions on disk, so identical runs are computed only once.
+# Off unless asked for: with runcache.enabled = True (or ThermEv(..., cache=True) for one run), evolve.ThermEv
+# looks every run up here first, under a hash of everything that decides its result: the planet dictionary,
+# method, thermals table, Tp0, dt and tmax, integrator settings, the mineral grid's checksum, and a stamp of
+# the code and library versions. A hit returns the stored Evolution (and leaves the planet as the run would
+# have), a miss runs as usual and stores the result. The store is bounded to constants.runcache_size MB;
+# the entries used longest ago are dropped first.
+# Runs are kept in cachedir: the EXOEVO_RUN_CACHE environment variable if set, else ~/.cache/exoevo/runs.
+# Entries are pickles, and unpickling runs code, so only point cachedir at a folder that you alone can write.
+# Recommended use:
+#   runcache.enabled = True      # cache every run in this session
+#   Evolution = evolve.ThermEv(planet, thermals, method, Tp0, tmax)               # cached
+#   Evolution = evolve.ThermEv(planet, thermals, method, Tp0, tmax, cache=False)  # bypass for one run
+#   runcache.cachedir = '/scratch/me/exoevo-runs'    # e.g. somewhere shared by a sweep's workers
+#   runcache.info(), runcache.clear()
+import os
+import sys
+import glob
+import pickle
+import hashlib
+import functools
+import numbers
+import threading
+import numpy as np
+import pandas as pd
+import profiling
+from constants import *
+
+CACHE_VERSION = 1
+here = os.path.dirname(os.path.abspath(__file__))
+cachedir = os.environ.get('EXOEVO_RUN_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'exoevo', 'runs'))
+enabled = False   # True caches every run; ThermEv(..., cache=...) decides per run
+sources = ['evolve.py', 'getall.py', 'history.py', 'kernel.py', 'constants.py', 'mineralDB.py',
+           'thermalgrid.py', 'fromexo.py', 'runcache.py']   # code whose changes make stored runs stale
+_size = {}   # folder -> MB stored as of its last scan plus what this process wrote since, so store rarely rescans
+
+def canonical(value):
+    # Purpose: a stable, hashable form of a planet dictionary (or any value inside it)
+    # Outputs: nested tuples of strings; numbers as float repr, so 2000 and 2000.0 match; arrays by dtype,
+    #   shape and a hash of their bytes; files named by a string by their size and modification time
+    # Limitations: other objects are taken apart through their attributes; raises TypeError if that's not possible
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((str(k), canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return ('list',) + tuple(canonical(v) for v in value)
+    if isinstance(value, str):
+        if os.path.isfile(value):   # e.g. planet['profile']: an ExoPlex file, which may be rewritten
+            st = os.stat(value)
+            return ('file', os.path.abspath(value), str(st.st_size), str(st.st_mtime_ns))
+        return ('str', value)
+    if value is None or isinstance(value, bool):
+        return ('const', repr(value))
+    if isinstance(value, numbers.Number):
+        return ('num', repr(float(value)))
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value)
+        if data.dtype == object:
+            return ('list',) + tuple(canonical(v) for v in data.tolist())
+        return ('array', str(data.dtype), str(data.shape), hashlib.sha256(data.tobytes()).hexdigest())
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return ('pandas', str(pd.util.hash_pandas_object(value).sum()), canonical(list(value.shape)))
+    if hasattr(value, '__dict__'):   # e.g. a fromexo.ExoPlexProfile
+        return ('object', type(value).__name__, canonical(vars(value)))
+    raise TypeError('Cannot key a run on a value of type ' + type(value).__name__)
+
+@functools.lru_cache(maxsize=1)
+def code_stamp():
+    # Hash of the sources that compute a run, and of the library versions; worked out once per session
+    digest = hashlib.sha256()
+    for name in sources:
+        path = os.path.join(here, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(' '.join([str(CACHE_VERSION), sys.version, np.__version__, pd.__version__]).encode())
+    return digest.hexdigest()
+
+def key(planet, thermals, method, Tp0, tmax, every=1, integrator='euler', rtol=1.0e-6, jit=False):
+    # Purpose: the content address of one ThermEv run
+    # Inputs: ThermEv's arguments, before the run (ThermEv changes the planet)
+    # Outputs: hex digest, or None if some value in the planet can't be keyed (the run is then not cached)
+    # Calls: canonical, code_stamp, thermalgrid.load (for methods that mix thermals from the grid)
+    import evolve
+    checksum = None
+    if method in ('dynamic', 'static'):
+        import thermalgrid
+        checksum = thermalgrid.load().checksum
+    try:
+        parts = canonical({'planet': planet, 'thermals': None if thermals is None else np.asarray(thermals, dtype=float),
+                           'method': method, 'Tp0': Tp0, 'tmax': tmax, 'dt': dt, 'seconds': seconds, 'R': R,
+                           'every': every, 'integrator': integrator, 'jit': bool(jit),
+                           'rtol': rtol if integrator == 'adaptive' else None,
+                           'Ts': evolve.Ts, 'radio': evolve.radio, 'grid': checksum, 'code': code_stamp()})
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+def entry(digest, folder=None):
+    return os.path.join(cachedir if folder is None else folder, digest + '.pkl')
+
+def fetch(digest, folder=None):
+    # Purpose: a stored run, if there is one
+    # Outputs: (Evolution DataFrame, planet dictionary as the run left it), or None
+    path = entry(digest, folder)
+    try:
+        with open(path, 'rb') as f:
+            stored = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        stored = None
+    else:
+        try:
+            os.utime(path)   # marks it as recently used, for eviction
+        except OSError:
+            pass
+    if profiling.active is not None:
+        profiling.active.count('run cache hits' if stored is not None else 'run cache misses')
+    if stored is None:
+        return None
+    if verbose == "true":
+        print('Evolution of', stored['planet'].get('ID'), 'from the run cache')
+    return stored['Evolution'], stored['planet']
+
+def store(digest, Evolution, planet, folder=None, limit=runcache_size):
+    # Purpose: keeps a finished run, then trims the cache to limit MB
+    # Limitations: a cache that can't be written (e.g. read-only checkout) is skipped without complaint;
+    #   planets that can't be pickled are not stored
+    folder = cachedir if folder is None else folder
+    path = entry(digest, folder)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        temporary = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump({'Evolution': Evolution, 'planet': dict(planet)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)   # so concurrent workers (processes or threads) never read half a file
+        size = _size.get(folder)
+        _size[folder] = (size if size is not None else limit) + os.path.getsize(path) / 1.0e6
+        if size is None or _size[folder] > limit:
+            evict(folder, limit)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        pass
+
+def evict(folder=None, limit=runcache_size):
+    # Purpose: drops the least recently used entries until the cache holds at most limit MB
+    # Outputs: number of entries removed
+    folder = cachedir if folder is None else folder
+    entries = []
+    for path in glob.glob(os.path.join(folder, '*.pkl')):
+        try:
+            st = os.stat(path)
+        except OSError:   # removed by another process meanwhile
+            continue
+        entries.append((st.st_mtime_ns, st.st_size, path))
+    total = sum(size for used, size, path in entries)
+    removed = 0
+    for used, size, path in sorted(entries):
+        if total <= limit * 1.0e6:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total = total - size
+        removed = removed + 1
+    _size[folder] = total / 1.0e6
+    return removed
+
+def info(folder=None):
+    # Number of stored runs and their size in MB
+    paths = glob.glob(os.path.join(cachedir if folder is None else folder, '*.pkl'))
+    return {'runs': len(paths), 'MB': sum(os.path.getsize(p) for p in paths if os.path.exists(p)) / 1.0e6}
+
+def clear(folder=None):
+    # Removes every stored run; returns how many there were
+    return evict(folder, limit=0)
@@ -0,0 +1,92 @@
+# A module for running many planets at once, one process per core.
+# Recommended use, e.g. for every planet in cumulative.csv:
+#   import sweep
+#   Evolutions, status = sweep.run_summary(method='dynamic', workers=8)
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import evolve
+import fromexo
+from history import timesteps
+from constants import *
+
+def evolve_one(job):
+    # Purpose: evolves one planet inside a worker, turning any failure into a status instead of an exception
+    # Inputs: tuple of (planet dictionary, method, tmax, dictionary of extra ThermEv keyword arguments)
+    # Outputs: tuple of (Evolution DataFrame or None, status dictionary)
+    planet, method, tmax, options = job
+    status = {'ID': planet['ID'], 'status': 'ok', 'message': '', 'temp': np.nan, 'Ra': np.nan, 'Urey': np.nan}
+    try:
+        Evolution = evolve.ThermEv(planet, None, method, planet['Tp0'], tmax, **options)   # prepare mixes any thermals
+    except Exception as err:
+        status.update({'status': 'error', 'message': type(err).__name__ + ': ' + str(err)})
+        return None, status
+    if len(Evolution) == 0 or Evolution['time'].iloc[-1] < timesteps(tmax, dt)[-1]:
+        status.update({'status': 'broke', 'message': 'Tp went negative'})
+    if len(Evolution) > 0:
+        status.update({c: Evolution[c].iloc[-1] for c in ('temp', 'Ra', 'Urey')})
+    return Evolution, status
+
+def run(planets, method='dynamic', tmax=tmax, workers=None, chunksize=1, output=None, keep=True, **options):
+    # Purpose: fans a collection of planets out over a process pool, and gathers their evolutions
+    # Inputs: list (or dictionary) of planet dictionaries as passed to evolve.ThermEv; the thermal method;
+    #   workers: number of processes (default: one per core; 1 runs in this process);
+    #   chunksize: planets handed to a worker at a time; output: an output.Writer (or the path of a
+    #   Parquet output folder) to stream each evolution to as it arrives, with its planet and status as parameters;
+    #   keep: also return the evolutions (False saves memory when writing to output); options: passed on to evolve.ThermEv
+    # Outputs: one DataFrame of every planet's evolution (empty if keep=False), and one row of status per planet
+    #   ('ok', 'broke' if Tp went negative, or 'error' with its message), with final temp, Ra, and Urey
+    # Limitations: planets that fail are reported in status, and left out of the evolutions
+    # Calls: evolve_one, output.Writer
+    if isinstance(planets, dict):
+        planets = list(planets.values())
+    jobs = [(planet, method, tmax, options) for planet in planets]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    writer = output
+    if isinstance(output, str):
+        import output as results_output
+        writer = results_output.Writer(output, metadata={'method': method, 'tmax': tmax, 'options': options})
+    if workers == 1 or len(jobs) < 2:
+        results = map(evolve_one, jobs)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(evolve_one, jobs, chunksize=chunksize)
+    try:
+        results = [collect(result, job, writer, keep) for result, job in zip(results, jobs)]
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if writer is not None and writer is not output:
+            writer.close()
+    Evolutions = [Evolution for Evolution, status in results if Evolution is not None]
+    if Evolutions:
+        Evolutions = pd.concat(Evolutions, ignore_index=True)
+    else:
+        Evolutions = pd.DataFrame(columns=outcols)
+    status = pd.DataFrame([status for Evolution, status in results])
+    return Evolutions, status
+
+def collect(result, job, writer, keep):
+    # Passes one finished planet to the writer, if any, as it arrives from the pool
+    Evolution, status = result
+    if writer is not None and Evolution is not None:
+        parameters = dict(job[0])
+        parameters.update(status)
+        writer.write(Evolution, parameters)
+    return (Evolution if keep else None), status
+
+def run_summary(method='dynamic', Tp0=DEFAULT['Tp0'], Qpl=1.0, Pref=5.0, tmax=tmax, workers=None, chunksize=1,
+                output=None, keep=True, **options):
+    # Purpose: runs every planet returned by fromexo.planets_from_summary, as in the
+    #   "Compare a grid of self-consistent mantle compositions" workflow of ExoEvo.ipynb
+    # Inputs: thermal method, starting Tp, relative heat production, reference pressure, end time,
+    #   and the process pool settings and ThermEv options of run()
+    # Outputs: as for run()
+    # Calls: fromexo.planets_from_summary, fromexo.summary_planet, run
+    files = fromexo.planets_from_summary()
+    planets = [fromexo.summary_planet(files[ID], ID, Tp0=Tp0, Qpl=Qpl, Pref=Pref) for ID in files]
+    return run(planets, method=method, tmax=tmax, workers=workers, chunksize=chunksize, output=output, keep=keep,
+               **options)
@@ -0,0 +1,268 @@
+# A module for the packed mineral property grid.
+# The P/T grids in alphagrid/ and CPgrid/ are parsed once, and packed into a single array
+# (mineral x property x T x P) saved as mineralgrid.npy, with its axes, version, checksum and a
+# fingerprint of the source CSVs in mineralgrid.json. Later loads memory-map the array, and
+# rebuild it automatically if any source CSV has changed.
+# Recommended use:
+#   import thermalgrid
+#   grid = thermalgrid.load()
+#   alpha, Cp, k, outside = grid.interpolator(composition)(T, P)   # arrays of (T, P) pairs, in one call
+import os
+import json
+import glob
+import hashlib
+import numpy as np
+from constants import DEFAULT
+from mineralDB import minerals as mins
+import profiling
+
+GRID_VERSION = 1
+here = os.path.dirname(os.path.abspath(__file__))
+cubefile = os.path.join(here, 'mineralgrid.npy')
+metafile = os.path.join(here, 'mineralgrid.json')
+properties = ['alpha', 'Cp']
+gridfiles = {'alpha': ('alphagrid', '_alphagrid.csv'), 'Cp': ('CPgrid', '_cpgrid.csv')}
+
+def grid_name(mineral):
+    # Purpose: translates a mineralDB key to the name used by its grid files, e.g. 'Gt_maj' -> 'Gtmaj'
+    return ''.join(char for char in str(mineral) if char.isalnum())
+
+def source_files():
+    # Purpose: lists the grid CSVs of every mineral that has both an alpha and a Cp grid
+    # Outputs: sorted list of grid names, and dictionary of {grid name: [alpha file, Cp file]}
+    folder, suffix = gridfiles['alpha']
+    names = sorted(os.path.basename(f)[:-len(suffix)] for f in glob.glob(os.path.join(here, folder, '*' + suffix)))
+    files = {}
+    for name in names:
+        files[name] = [os.path.join(here, gridfiles[prop][0], name + gridfiles[prop][1]) for prop in properties]
+    names = [name for name in names if all(os.path.exists(f) for f in files[name])]
+    return names, {name: files[name] for name in names}
+
+def fingerprint(files):
+    # Purpose: cheap signature (size and modification time) of each source CSV, to detect stale cubes
+    signature = {}
+    for name in sorted(files):
+        for f in files[name]:
+            st = os.stat(f)
+            signature[os.path.relpath(f, here)] = [st.st_size, st.st_mtime_ns]
+    return signature
+
+def build(cube=cubefile, meta=metafile):
+    # Purpose: one-time packing of every mineral grid into a single array plus a metadata file
+    # Inputs: output paths for the array (.npy) and its metadata (.json)
+    # Outputs: the metadata dictionary that was written
+    # Limitations: all grids must share the T axis (first column) and P axis (header) of the first grid
+    # Calls: source_files, fingerprint
+    names, files = source_files()
+    T, P = None, None
+    data = None
+    for m, name in enumerate(names):
+        for q, f in enumerate(files[name]):
+            with open(f, 'r') as csv:
+                header = np.array(csv.readline().strip().split(',')[1:], dtype=float)
+            table = np.genfromtxt(f, delimiter=',', skip_header=1)
+            if T is None:
+                T, P = table[:, 0], header
+                data = np.empty((len(names), len(properties), len(T), len(P)))
+            if not (np.array_equal(table[:, 0], T) and np.array_equal(header, P)):
+                raise ValueError('Grid axes of ' + f + ' do not match the other mineral grids.')
+            data[m, q] = table[:, 1:]
+    metadata = {'version': GRID_VERSION, 'minerals': names, 'properties': properties,
+                'T': T.tolist(), 'P': P.tolist(), 'shape': list(data.shape),
+                'sha256': hashlib.sha256(data.tobytes()).hexdigest(),
+                'sources': fingerprint(files)}
+    np.save(cube + '.tmp.npy', data)   # write-then-rename, so concurrent readers never see half a file
+    os.replace(cube + '.tmp.npy', cube)
+    with open(meta + '.tmp', 'w') as f:
+        json.dump(metadata, f)
+    os.replace(meta + '.tmp', meta)
+    return metadata
+
+class MineralGrid:
+    # Purpose: read-only view of the packed grid, with explicit axes
+    # Attributes: data (mineral x property x T x P array), minerals (grid names), properties, T (K), P (GPa),
+    #   index (grid name -> mineral row), checksum (sha256 of data, from the build)
+    def __init__(self, data, metadata):
+        self.data = data
+        self.minerals = metadata['minerals']
+        self.properties = metadata['properties']
+        self.T = np.asarray(metadata['T'])
+        self.P = np.asarray(metadata['P'])
+        self.checksum = metadata['sha256']
+        self.version = metadata['version']
+        self.index = {name: m for m, name in enumerate(self.minerals)}
+
+    def verify(self):
+        # Recomputes the checksum of the loaded array; True if it matches the build
+        return hashlib.sha256(np.ascontiguousarray(self.data).tobytes()).hexdigest() == self.checksum
+
+    def row(self, mineral):
+        # Mineral row for a mineralDB key or grid name, or None if that mineral has no grid
+        return self.index.get(grid_name(mineral))
+
+    def interpolator(self, composition=None, clamp=True):
+        # ThermalInterpolator over this grid's axes, for a composition (see ThermalInterpolator.from_grid);
+        #   with no composition, one that only locates points on the axes (see ThermalInterpolator.locate)
+        if composition is None:
+            return ThermalInterpolator(self.T, self.P, clamp=clamp)
+        return ThermalInterpolator.from_grid(composition, self, clamp)
+
+_grid = None
+on_reload = []  # invalidation hooks: functions called with no arguments whenever a new grid is loaded
+
+@profiling.profiled()
+def load(verify=False, rebuild=False):
+    # Purpose: returns the packed mineral grid, building or rebuilding the cube file if needed
+    # Inputs: verify: recompute the checksum after loading; rebuild: force a fresh build
+    # Outputs: MineralGrid, memory-mapped from cubefile; kept in memory for later calls
+    # Limitations: if the cube can't be written (read-only checkout), it is built in the home directory instead
+    # Calls: build, fingerprint, source_files
+    global _grid
+    if _grid is not None and not rebuild:
+        return _grid
+    metadata = None
+    if not rebuild and os.path.exists(cubefile) and os.path.exists(metafile):
+        with open(metafile, 'r') as f:
+            metadata = json.load(f)
+        if metadata.get('version') != GRID_VERSION or metadata.get('sources') != fingerprint(source_files()[1]):
+            metadata = None
+    path = cubefile
+    if metadata is None:
+        try:
+            metadata = build()
+        except OSError:
+            path = os.path.join(os.path.expanduser('~'), '.exoevo_mineralgrid')
+            metadata = build(path + '.npy', path + '.json')
+            path = path + '.npy'
+    grid = MineralGrid(np.load(path, mmap_mode='r'), metadata)
+    if verify and not grid.verify():
+        return load(verify=False, rebuild=True)
+    _grid = grid
+    for hook in on_reload:
+        hook()
+    return _grid
+
+
+def spacing(axis):
+    # Step of an evenly spaced axis (as the grid's T and P axes are), or None
+    axis = np.asarray(axis, dtype=float)
+    if len(axis) < 2:
+        return None
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    return step if np.allclose(np.diff(axis), step, rtol=1.0e-9, atol=0.0) else None
+
+def bracket(axis, x, clamp=True, step=None):
+    # Purpose: vectorized search for the grid interval holding each x
+    # Inputs: increasing 1-D axis; array of query points; clamp: hold points outside the axis at its ends (True),
+    #   or extrapolate them linearly from the end intervals (False); step: spacing of an evenly spaced axis
+    #   (see spacing), to find the intervals arithmetically instead of searching for them
+    # Outputs: lower index of each interval, weight of the upper node, and a mask of points outside the axis
+    # Limitations: on an axis with a single node, every point takes that node (index 0, weight 0)
+    x = np.asarray(x, dtype=float)
+    outside = (x < axis[0]) | (x > axis[-1])
+    if len(axis) < 2:
+        return np.zeros(x.shape, dtype=int), np.zeros(x.shape), outside
+    if clamp:
+        x = np.clip(x, axis[0], axis[-1])
+    if step is None:
+        i = np.searchsorted(axis, x, side='right') - 1
+    else:
+        i = np.floor((x - axis[0]) / step)
+    i = np.clip(i, 0, len(axis) - 2).astype(int)
+    w = (x - axis[i]) / (axis[i + 1] - axis[i])
+    return i, w, outside
+
+class ThermalInterpolator:
+    # Purpose: bilinear T-P interpolation of alpha, Cp, and k, evaluated for whole arrays of (T, P) pairs in one call
+    # Inputs: T (K) and P (GPa) axes, both increasing; values: (T x P x 3) array of alpha, Cp, and k at the nodes,
+    #   or a stack of such arrays (tables x T x P x 3); clamp: hold points outside the axes at the grid's edge (True),
+    #   or extrapolate them from the edge intervals (False); k_lower: read k at the lower T node instead of
+    #   interpolating it in T, as getall.Tdep_thermals does
+    # Outputs: calling it on arrays T and P (and, for a stack, the table of each point) returns alpha, Cp, k,
+    #   and a mask of the points that fell outside the grid
+    # Limitations: an axis with a single node (e.g. tables mixed at one pressure) is constant along it.
+    #   With values None, the interpolator only locates points (see locate).
+    # Calls: bracket, spacing
+    def __init__(self, T, P, values=None, clamp=True, k_lower=False):
+        self.T = np.asarray(T, dtype=float)
+        self.P = np.asarray(P, dtype=float)
+        self.values = None if values is None else np.asarray(values, dtype=float)
+        self.clamp = clamp
+        self.k_lower = k_lower
+        self.steps = (spacing(self.T), spacing(self.P))
+
+    @classmethod
+    def from_grid(cls, composition, grid=None, clamp=True):
+        # Purpose: mixes a composition's alpha, Cp, and k over the whole mineral grid, once
+        # Inputs: composition dictionary (mineralDB keys and weights), optionally a MineralGrid (default: load())
+        # Limitations: k is the weighted mineralDB value plus the radiative term, as in getall.thermals_at_P_ave,
+        #   so it depends on T but not P. Minerals without a grid take DEFAULT alpha and Cp.
+        # Refs: radiative k from 10.1126/science.283.5408.1699
+        grid = load() if grid is None else grid
+        values = np.zeros((len(grid.T), len(grid.P), 3))
+        k = 0.0
+        for i in composition:
+            m = grid.row(i)
+            if m is not None:
+                values[:, :, :2] += composition[i] * np.moveaxis(grid.data[m], 0, -1)
+            else:
+                values[:, :, 0] += composition[i] * DEFAULT['alpha']
+                values[:, :, 1] += composition[i] * DEFAULT['Cp']
+            k = k + composition[i] * mins.get(i, {}).get('k', DEFAULT['k'])
+        values[:, :, 2] = (k + (8.5 * grid.T ** 3) / (1.0e11))[:, None]
+        return cls(grid.T, grid.P, values, clamp)
+
+    @classmethod
+    def from_tables(cls, thermals):
+        # Purpose: interpolator over thermals tables (columns T, alpha, Cp, k), as getall.Tdep_thermals reads them:
+        #   linear in T, k at the lower T node, extrapolated past the table's ends
+        # Inputs: one (nT x 4) table, or a stack of (n x nT x 4) tables that share one T column
+        # Outputs: ThermalInterpolator with a single-node P axis (call it with P=None); the values are a view
+        #   of thermals, not a copy
+        thermals = np.asarray(thermals, dtype=float)
+        T = thermals[..., 0].reshape(-1, thermals.shape[-2])
+        if not np.all(T == T[0]):
+            raise ValueError('Stacked thermals tables must share one T column.')
+        return cls(T[0], [np.nan], thermals[..., :, None, 1:], clamp=False, k_lower=True)
+
+    def locate(self, T=None, P=None):
+        # Nodes and weights for points at T and P: lower T index, weight of the upper T node, the same in P,
+        #   and the mask of points outside the grid. Pass only T or only P to look up one axis (the other gives None).
+        iT = wT = iP = wP = None
+        outside = False
+        if T is not None:
+            iT, wT, outT = bracket(self.T, T, self.clamp, self.steps[0])
+            outside = outside | outT
+        if P is not None:
+            iP, wP, outP = bracket(self.P, P, self.clamp, self.steps[1])
+            outside = outside | outP
+        return iT, wT, iP, wP, outside
+
+    def _column(self, lead, iT, wT, iP):
+        # Values at T, linear between the T nodes of pressure column iP
+        lo, hi = self.values[lead + (iT, iP)], self.values[lead + (iT + 1, iP)]
+        value = lo * (1 - wT)[..., None] + hi * wT[..., None]
+        if self.k_lower:
+            value[..., 2] = lo[..., 2]
+        return value
+
+    def __call__(self, T, P=None, table=None):
+        # T (K) and P (GPa) arrays, broadcast together; P None takes the first pressure node (for tables at one
+        #   pressure); table: index of each point's table, if values is a stack
+        T = np.asarray(T, dtype=float)
+        if P is not None:
+            T, P = np.broadcast_arrays(T, np.asarray(P, dtype=float))
+        iT, wT, iP, wP, outside = self.locate(T, P)
+        lead = () if table is None else (np.asarray(table),)
+        if P is None:
+            value = self._column(lead, iT, wT, 0)
+        else:
+            value = self._column(lead, iT, wT, iP)
+            if len(self.P) > 1:
+                value = value * (1 - wP)[..., None] + self._column(lead, iT, wT, iP + 1) * wP[..., None]
+        return value[..., 0], value[..., 1], value[..., 2], np.broadcast_to(outside, T.shape)
+
+if __name__ == '__main__':
+    # python thermalgrid.py : (re)build the cube after adding or editing grid CSVs
+    metadata = build()
+    print('Packed', len(metadata['minerals']), 'mineral grids into', cubefile, 'sha256:', metadata['sha256'])
@@ -0,0 +1,163 @@
+# A resident evolution worker, answering planets sent as JSON lines.
+# Started once, it pays for imports, the mineral grid, and any ExoPlex files up front, then keeps the
+# in-memory caches (mixed thermals, parsed profiles) warm across requests. Each request is one line of
+# JSON; each answer is one line of JSON, written as soon as its run is done. On stdin, requests are
+# answered in turn; on a Unix socket, every client connection is served by its own thread, so several
+# tools can query the same worker at once.
+# A request: {"id": 7, "planet": {"ID": "b", "Mpl": 1.2, "Rpl": 1.1, "Qpl": 1.0, "Tp0": 1900, "Pref": 6.0,
+#   "composition": {"Pv": 60, "O": 40}, "constants": {"beta": 0.33}}, "method": "dynamic", "tmax": 4.55,
+#   "output": "summary"}
+#   optional: "file" and "startline" (an ExoPlex CSV, which sets the structure and composition), "output": "history" (every
+#   recorded step, thinned by "every"), and ThermEv's "integrator", "rtol", "jit", and "cache"
+# An answer: {"id": 7, "status": "ok", "ID": "b", "final": {"temp": ..., "Ra": ..., "Urey": ..., "passfail": ...},
+#   "seconds": ...}, plus "history": {column: [values]} if asked for; or {"id": 7, "status": "error", "message": ...}
+# {"command": "ping"} answers {"status": "ok"}, to check a worker is up.
+# Recommended use:
+#   python worker.py < planets.jsonl > results.jsonl
+#   python worker.py --socket /tmp/exoevo.sock --preload earth.csv &
+#   answers = worker.ask('/tmp/exoevo.sock', [request, ...])     # from any local client
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import socketserver
+import numpy as np
+import evolve
+import fromexo
+import getall as get
+import thermalgrid
+from constants import *
+
+OPTIONS = ('integrator', 'rtol', 'jit', 'cache')   # request keys passed on to evolve.ThermEv
+
+def warm(files=()):
+    # Purpose: loads what every later request would otherwise load on first use
+    # Inputs: ExoPlex files to parse ahead of time
+    thermalgrid.load()
+    for file in files:
+        fromexo.load_profile(file)
+
+def planet_from(request):
+    # Purpose: the planet dictionary for a request, built as main.py builds it
+    # Inputs: request dictionary; its 'planet' is built from Mpl and Rpl (in Earth units), or from an ExoPlex 'file'
+    #   (with an optional 'startline' where the mantle starts); without either, the method's presets and DEFAULT apply
+    # Outputs: planet dictionary ready for evolve.ThermEv
+    # Calls: fromexo.bulk_mass_fraction, fromexo.build, get.adds_up, get.build
+    planet = dict(request.get('planet', {}))
+    planet.setdefault('ID', str(request.get('id', 'planet')))
+    planet.setdefault('Tp0', DEFAULT['Tp0'])
+    planet.setdefault('Qpl', 1.0)
+    planet.setdefault('constants', {})
+    planet.setdefault('outcols', list(outcols))
+    file = request.get('file')
+    if file is not None:
+        if 'composition' not in planet:
+            planet['composition'] = fromexo.bulk_mass_fraction(file, request.get('startline'))
+        planet = fromexo.build(planet, file)
+    elif 'Mpl' in planet and 'Mp' not in planet:
+        planet = get.build(planet)
+    if 'composition' in planet:
+        planet['composition'] = get.adds_up(dict(planet['composition']))
+    if 'Pref' in planet and planet['Pref'] != 'depth' and 'Pcmb' in planet and planet['Pref'] < 4.001:
+        planet['Pref'] = 0.5*planet['Pcmb']
+    return planet
+
+def answer(request):
+    # Purpose: runs one request
+    # Outputs: answer dictionary, as described at the top; failures become status 'error' rather than exceptions
+    # Calls: planet_from, evolve.ThermEv (which mixes the thermals for 'dynamic' and 'static' runs)
+    if request.get('command') == 'ping':
+        return {'id': request.get('id'), 'status': 'ok'}
+    start = time.perf_counter()
+    reply = {'id': request.get('id'), 'status': 'ok'}
+    try:
+        method = request.get('method', request.get('planet', {}).get('method', 'dynamic'))
+        planet = planet_from(request)
+        reply['ID'] = planet['ID']
+        options = {key: request[key] for key in OPTIONS if key in request}
+        Evolution = evolve.ThermEv(planet, None, method, request.get('Tp0', planet['Tp0']),
+                                   request.get('tmax', tmax), every=request.get('every', 1), **options)
+    except Exception as err:
+        reply.update({'status': 'error', 'message': type(err).__name__ + ': ' + str(err)})
+        return reply
+    if len(Evolution) > 0:
+        reply['final'] = {c: Evolution[c].iloc[-1] for c in ('time', 'temp', 'Ra', 'Urey', 'passfail') if c in Evolution}
+    if request.get('output', 'summary') == 'history':
+        reply['history'] = {c: Evolution[c].tolist() for c in Evolution.columns}
+    reply['seconds'] = time.perf_counter() - start
+    return reply
+
+def encode(reply):
+    # One line of JSON; NumPy scalars become plain numbers
+    return json.dumps(reply, default=lambda value: value.item() if isinstance(value, np.generic) else str(value)) + '\n'
+
+def respond(line):
+    # The answer line for one request line
+    try:
+        request = json.loads(line)
+    except ValueError as err:
+        return encode({'id': None, 'status': 'error', 'message': 'not JSON: ' + str(err)})
+    return encode(answer(request))
+
+def serve_stdin(stdin=None, stdout=None):
+    # Purpose: answers requests from stdin (one per line) on stdout, until stdin closes
+    # Limitations: messages that the model prints go to stderr, so stdout holds only answers
+    stdin = sys.stdin if stdin is None else stdin
+    saved = sys.stdout
+    out = saved if stdout is None else stdout
+    sys.stdout = sys.stderr
+    try:
+        for line in stdin:
+            if line.strip():
+                out.write(respond(line))
+                out.flush()
+    finally:
+        sys.stdout = saved
+
+class Handler(socketserver.StreamRequestHandler):
+    # Answers every request line of one client connection, in order
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(respond(line.decode()).encode())
+                self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve_socket(path):
+    # Purpose: answers clients on a local Unix socket at path, one thread per connection, until interrupted
+    if os.path.exists(path):
+        os.remove(path)   # left over from a worker that didn't shut down cleanly
+    with Server(path, Handler) as server:
+        print('ExoEvo worker listening on', path, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+def ask(path, requests):
+    # Purpose: client side: sends requests to a worker's socket, and returns its answers in the same order
+    # Inputs: socket path; list of request dictionaries
+    # Outputs: list of answer dictionaries
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(''.join(json.dumps(request) + '\n' for request in requests).encode())
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('r') as answers:
+            return [json.loads(line) for line in answers]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident ExoEvo worker: answers planets sent as JSON lines.')
+    parser.add_argument('--socket', help='serve on this Unix socket instead of stdin/stdout')
+    parser.add_argument('--preload', nargs='*', default=[], help='ExoPlex files to parse before the first request')
+    args = parser.parse_args()
+    warm(args.preload)
+    if args.socket:
+        serve_socket(args.socket)
+    else:
+        serve_stdin()